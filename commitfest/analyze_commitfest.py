@@ -1,61 +1,159 @@
 
-from scrape import parse_commitfest_page, get_patch_info
+from scrape import parse_commitfest_page, get_patch_info, fetch_patch_info, get_parsed_thread, parsed_thread_version
 from analyze_thread import analyze_thread
 from predict_committers import predict_committers
 from thread_story import tell_thread_story, rank_for_beginners
-from draw_thread_story import draw_thread
+from draw_thread_story import draw_story
 from attachments import analyze_attachment
 from worker import run_jobs
+from fetch import HTTP_CONCURRENCY
+from cache import print_cache_stats
+from pipeline import Pipeline, run_dirty_jobs, load_item, save_item, version_of
+from identities import resolve_identities, history_aliases
 from write_csv import dict_to_csv, array_of_dict_to_csv
 from pprint import pprint
+import argparse
 import json
+import os
 
 
-def analyze_commitfest(id):  
-    #1. Scrape the list of patches.
-    url = f"https://commitfest.postgresql.org/{id}/"
-    patch_ids, contributer_names = parse_commitfest_page(url)
-    csv_of_contributor_names = [{"name": name } for name in set(contributer_names)]
+def thread_versions(thread_ids, since=None, latest_activity=None):
+    """
+    A version for each thread, which changes whenever the thread does. With
+    since (an ISO date), threads whose latest message according to
+    latest_activity ({thread id: date}, read from the commitfest app on this
+    run) is before it keep the version from the last run without being fetched
+    again. Threads missing from latest_activity are always fetched.
+    """
+    latest_activity = latest_activity or {}
+
+    def thread_version(thread_id):
+        recorded = load_item("threads", thread_id)
+        latest = latest_activity.get(thread_id)
+        if since and recorded is not None and latest is not None and latest < since:
+            return recorded["output"]
+
+        parsed = get_parsed_thread(thread_id)
+        output = {
+            "version": parsed_thread_version(thread_id),
+            "last_activity": parsed["from_and_date"][-1][1] if parsed["from_and_date"] else "",
+        }
+        save_item("threads", thread_id, output["version"], output)
+        return output
 
-    print(patch_ids)
+    versions = run_jobs(thread_version, thread_ids, max_workers=HTTP_CONCURRENCY)
+    # a thread we couldn't fetch gets a version that never matches, so its stages run (and fail) again
+    return {thread: v["version"] if "version" in v else None for thread, v in versions.items()}
 
-    # Scrape patches  in parallel.
-    patch_info = run_jobs(get_patch_info, patch_ids, 5)
-    pprint(patch_info)
+
+def analyze_commitfest(id, since=None):
+    pipeline = Pipeline()
+
+    #1. Scrape the list of patches.
+    @pipeline.stage("patches")
+    def patches(_inputs):
+        url = f"https://commitfest.postgresql.org/{id}/"
+        patch_ids, contributer_names = parse_commitfest_page(url)
+        print(patch_ids)
+
+        # Scrape patches  in parallel. With --since, the patch pages decide which
+        # threads to look at, so they have to be current rather than cached.
+        patch_info = run_jobs(fetch_patch_info if since else get_patch_info, patch_ids, HTTP_CONCURRENCY)
+        pprint(patch_info)
+
+        latest_activity = {}
+        for patch in patch_info.values():
+            latest_activity.update(patch.get("latest_activity", {}))
+        patch_info = {patch_id: {key: value for key, value in patch.items() if key != "latest_activity"} for patch_id, patch in patch_info.items()}
+
+        message_ids = [message_id for patch in patch_info.values() for message_id in patch['message_ids']]
+        return {
+            "patch_info": patch_info,
+            "message_ids": message_ids,
+            "latest_activity": latest_activity,
+            "contributor_names": [{"name": name } for name in set(contributer_names)],
+        }
+
+    # Which threads changed since the last run; everything per-thread below only
+    # re-runs for those.
+    @pipeline.stage("threads", deps=["patches"])
+    def changed_threads(inputs):
+        return thread_versions(inputs["patches"]["message_ids"], since, inputs["patches"]["latest_activity"])
 
     # top-line analysis
-    message_ids = [message_id for patch in patch_info.values() for message_id in patch['message_ids']]
-    threads = run_jobs(analyze_thread, message_ids, max_workers=5)
+    @pipeline.stage("analysis", deps=["patches", "threads"])
+    def analysis(inputs):
+        versions = inputs["threads"]
+        return run_dirty_jobs("analysis", analyze_thread, inputs["patches"]["message_ids"], versions.get, max_workers=5)
 
     # target committer analysis
-    predicted_committers, extended_predictions = predict_committers(message_ids)
+    @pipeline.stage("committers", deps=["patches"])
+    def committers(inputs):
+        return predict_committers(inputs["patches"]["message_ids"])
+
+    # download attachments
+    @pipeline.stage("attachments", deps=["analysis"])
+    def attachments(inputs):
+        attachment_links = {id: { "links": thread["attachment_links"] } for id, thread in inputs["analysis"].items()}
+        links_flattened = [ (link, message_id) for message_id, link_obj in attachment_links.items() for link_list in link_obj.values() for link in link_list ]
+        attachment_stats  = run_jobs(analyze_attachment, links_flattened, max_workers=HTTP_CONCURRENCY)
+        return { f'{link}/{stats["file"]}': stats for link, files in attachment_stats.items() for stats in files }
+
+    # thread stories
+    @pipeline.stage("stories", deps=["patches", "threads"])
+    def stories(inputs):
+        versions = inputs["threads"]
+        return run_dirty_jobs("stories", tell_thread_story, inputs["patches"]["message_ids"], versions.get, max_workers=5)
+
+    @pipeline.stage("beginners", deps=["stories"])
+    def beginners(inputs):
+        beginner_payload = [(thread, story) for thread, story in inputs["stories"].items()]
+        return run_dirty_jobs("beginners", rank_for_beginners, beginner_payload, lambda x: version_of(x[1]), max_workers=10, payload_arg_key_fn=lambda x: x[0])
+
+    # svgs
+    @pipeline.stage("svgs", deps=["stories"])
+    def svgs(inputs):
+        stories = inputs["stories"]
+        svg_payload =  [(thread, f'../data/svg/{thread}.svg', story) for thread, story in stories.items()]
+        # redraw when the story changed, or the file has gone missing
+        svg_version = lambda x: version_of([x[2], os.path.exists(x[1])])
+        # drawing is pure CPU work, so spread it over processes
+        run_dirty_jobs("svgs", draw_story, svg_payload, svg_version, max_workers=4, payload_arg_key_fn=lambda x: x[0], lane="process")
+
+    # one integer id per person, however they're spelled in threads, the
+    # commitfest app and the commit log, so joins downstream needn't match names
+    @pipeline.stage("identities", deps=["patches", "analysis", "committers"])
+    def identities(inputs):
+        aliases = [contributor["name"] for contributor in inputs["patches"]["contributor_names"]]
+        for thread in inputs["analysis"].values():
+            if "stats" in thread:
+                aliases.append(thread["stats"]["author"])
+                aliases.extend(json.loads(thread["stats"]["reviewer_list"]))
+        _predicted, extended_predictions = inputs["committers"]
+        aliases.extend(extended_predictions["base_rates"].keys())
+        # the commit log's "name <email>" aliases are what tie names to emails
+        aliases.extend(history_aliases())
+
+        resolved, table = resolve_identities(aliases)
+        return [{"alias": alias, "person_id": person_id, "name": table.name_of(person_id)} for alias, person_id in sorted(resolved.items())]
+
+    results = pipeline.run()
+
+    patch_info = results["patches"]["patch_info"]
+    threads = results["analysis"]
+    predicted_committers, extended_predictions = results["committers"]
 
     thread_summaries = {id: thread["explanation"] for id, thread in threads.items()}
     thread_stats = {id: thread["stats"] for id, thread in threads.items()}
     attachment_links = {id: { "links": thread["attachment_links"] } for id, thread in threads.items()}
-
-    # download attachments
-    links_flattened = [ (link, message_id) for message_id, link_obj in attachment_links.items() for link_list in link_obj.values() for link in link_list ]
-    attachment_stats  = run_jobs(analyze_attachment, links_flattened, max_workers=5)
-    attachment_stats_flattened = { f'{link}/{stats["file"]}': stats for link, files in attachment_stats.items() for stats in files }
+    attachment_stats_flattened = results["attachments"]
 
     # link message <> patch for tf-idf
     message_of_patch = { patch_id: {"message_id": message_id} for patch_id, patch in patch_info.items() for message_id in patch['message_ids']}
 
     print(attachment_stats_flattened)
 
-    # thread stories
-    stories = run_jobs(tell_thread_story, message_ids, max_workers=5)
-    beginner_payload = [(thread, story) for thread, story in stories.items()]
-    beginners = run_jobs(rank_for_beginners, beginner_payload, max_workers=10, payload_arg_key_fn=lambda x: x[0])
-
-    stories_flattened = [message for story in stories.values() for message in story]
-
-    # svgs
-    svg_payload =  [(thread, f'../data/svg/{thread}.svg') for thread in stories.keys()]
-    run_jobs(draw_thread, svg_payload, max_workers=25, payload_arg_key_fn=lambda x: x[0])
-
-    
+    stories_flattened = [message for story in results["stories"].values() for message in story]
 
     dict_to_csv(patch_info, "patches.csv")
     dict_to_csv(thread_summaries, "thread_summaries.csv")
@@ -65,13 +163,21 @@ def analyze_commitfest(id):
     dict_to_csv(message_of_patch, "message_patch.csv")
     dict_to_csv(predicted_committers, "predicted_committers.csv")
     array_of_dict_to_csv(stories_flattened, "stories.csv")
-    dict_to_csv(beginners, "beginners.csv")
-    array_of_dict_to_csv(csv_of_contributor_names, "contributor_names.csv")
+    dict_to_csv(results["beginners"], "beginners.csv")
+    array_of_dict_to_csv(results["patches"]["contributor_names"], "contributor_names.csv")
+    array_of_dict_to_csv(results["identities"], "identities.csv")
 
     with open('extended_predictions.json', 'w') as f:
         # temporary dump to use for offline analysis
         json.dump(extended_predictions, f)
 
+    print_cache_stats()
+
 
 if __name__ == '__main__':
-    analyze_commitfest(52)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Scrape and analyze a commitfest.")
+    parser.add_argument("id", nargs="?", type=int, default=52, help="commitfest id")
+    parser.add_argument("--since", help="only look for changes in threads active since this date (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    analyze_commitfest(args.id, args.since)
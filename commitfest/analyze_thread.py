@@ -1,12 +1,20 @@
-from scrape import parse_thread
-from llm import prompt_gemini, clean_gemini_json
+from scrape import get_parsed_thread
+from llm import prompt_gemini
 from datetime import datetime
 import json
 from pprint import pprint
-from cache import cache_results
+from cache import cache_results, content_hash, legacy_value, adopt_legacy_entry
 
 def analyze_thread(thread_id):
-    text, attachment_links, from_and_date_list = parse_thread(thread_id)
+    parsed = get_parsed_thread(thread_id)
+    text, attachment_links, from_and_date_list = parsed["text"], parsed["attachment_links"], parsed["from_and_date"]
+
+    # Explanations used to be cached on the thread id alone, explained from the
+    # text parse_thread cached next to them: keep the old one while that's
+    # still the thread's text.
+    legacy_parse = legacy_value(f"parse_thread_{(thread_id,)}_{{}}")
+    if legacy_parse is not None and legacy_parse[0] == text:
+        adopt_legacy_entry(f"explain_thread_{thread_id}", f"explain_thread_{explanation_key(text, thread_id)}")
 
     explanation = explain_thread(text, thread_id)
 
@@ -27,7 +35,12 @@ def analyze_thread(thread_id):
     }
     
 
-@cache_results(1)
+def explanation_key(text, thread_id):
+    return f'{thread_id}_{content_hash(text)}'
+
+# The prompt embeds the current time, so cache on the thread's content instead:
+# the explanation is only refreshed once the thread itself changes.
+@cache_results(explanation_key)
 def explain_thread(text, thread_id): # thread_id argument used for cacheing
 
     prompt = f'''
@@ -113,20 +126,12 @@ def explain_thread(text, thread_id): # thread_id argument used for cacheing
 
     '''
 
-    summary = prompt_gemini(prompt)
-
-    try:
-        parsed = clean_gemini_json(summary)
-        return parsed
-    except:
-        print(summary)
-        raise ValueError("Unable to parse LLM response as JSON")
+    return prompt_gemini(prompt, as_json=True)
 
 
-@cache_results(0, 2)
 def summarize_thread_for_predicting_committer(args):
 
-    text, _not_used, _thread_id = args
+    text, _not_used, thread_id = args
 
     prompt = f'''
 
@@ -149,7 +154,9 @@ def summarize_thread_for_predicting_committer(args):
         know this is about PostgreSQL, but instead focus on the specific terms you find in the text.
     '''
 
-    summary = prompt_gemini(prompt)
+    # the summaries of the training threads take hours to build, so keep the ones
+    # cached on the thread id from before they were cached on the prompt
+    summary = prompt_gemini(prompt, legacy_key=f"summarize_thread_for_predicting_committer_{thread_id}")
 
     return summary
 
@@ -1,14 +1,15 @@
-import requests
 from cache import cache_results
+from fetch import http_get
+from worker import run_in_process
 
 @cache_results()
 def analyze_attachment(link_and_message_id):
 
     link, message_id = link_and_message_id
     absolute_url = 'https://postgresql.org/' + link
-    data = requests.get(absolute_url).text
+    data = http_get(absolute_url).text
 
-    stats = parse_git_patch(data, link, message_id)
+    stats = run_in_process(parse_git_patch, data, link, message_id)
 
     return stats
 
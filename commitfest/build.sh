@@ -29,7 +29,7 @@ psql -p 6565 -c "\
 # thread_stats: more info about threads
 psql -p 6565 -c "\
   SELECT json_agg(row_to_json(t)) \
-  FROM (SELECT * FROM thread_stats) t;" \
+  FROM (SELECT * FROM thread_stats_people) t;" \
   -t -A > ../data/thread_stats.json
 
 # patch_message: link a patch to its mailing threads, and vice versa
@@ -41,7 +41,7 @@ psql -p 6565 -c "\
 # predicted_committer: which of the committers do we think should look at a patch, and why? 
 psql -p 6565 -c "\
   SELECT json_agg(row_to_json(t)) \
-  FROM (SELECT * FROM predicted_committer) t;" \
+  FROM (SELECT * FROM predicted_committer_people) t;" \
   -t -A > ../data/predicted_committers.json
 
 # contributor_names: display names for users, and maybe eventually other info 
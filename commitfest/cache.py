@@ -1,41 +1,525 @@
 import os
+import sys
 import json
+import zlib
+import hashlib
+import sqlite3
+import time
+import threading
 import functools
+from collections import OrderedDict
+from contextlib import contextmanager
 
 CACHE_DIR = ".cache"
-def cache_results(key=None, subkey=None):
-    """Decorator to cache function results in a specified directory."""
+CACHE_DB = os.path.join(CACHE_DIR, "cache.sqlite3")
+
+# Which storage engine backs cache_results: "sqlite" (one indexed file, which
+# imports the JSON files on first use) or "json" (the original
+# one-file-per-call layout).
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "sqlite")
+
+# Returned by a revalidate function when the cached value is still current.
+NOT_MODIFIED = object()
+
+# Budget of the in-process LRU tier, shared by every cached function, in bytes
+# of serialized JSON. The deserialized values take several times that.
+MEMORY_CACHE_BYTES = int(os.environ.get("MEMORY_CACHE_MB", 128)) * 1024 * 1024
+
+
+class JsonDirStore:
+    """One JSON file per cache key, in a flat directory."""
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, f"{key}.meta")
+
+    def _write(self, path, serialized):
+        # Write to a temporary file and rename it into place, so a crash
+        # mid-write never leaves a truncated entry behind.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(serialized)
+        os.replace(tmp_path, path)
+
+    def get_entry(self, key):
+        """Return (serialized JSON, stored_at, meta) for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                serialized = f.read()
+            stored_at = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(self._meta_path(key), "r") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            meta = {}
+        return serialized, stored_at, meta
+
+    def put_raw(self, key, serialized, meta=None):
+        if meta:
+            self._write(self._meta_path(key), json.dumps(meta))
+        self._write(self._path(key), serialized)
+
+    def touch(self, key, meta=None):
+        """Mark an entry as freshly validated."""
+        if meta:
+            self._write(self._meta_path(key), json.dumps(meta))
+        os.utime(self._path(key))
+
+
+class SqliteStore:
+    """
+    All cache entries in a single SQLite file, keyed on an indexed primary key,
+    with zlib-compressed JSON values.
+    """
+
+    def __init__(self, path=CACHE_DB, legacy_dir=CACHE_DIR):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # run_jobs calls us from many threads, so share one connection behind a lock.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, value BLOB NOT NULL, stored_at REAL NOT NULL DEFAULT 0, meta TEXT)"
+        )
+        self.conn.commit()
+
+        # A new database starts out with everything the JSON store had cached
+        # next to it, so switching stores doesn't mean fetching and prompting
+        # all over again. user_version marks the import as done, so one that
+        # was interrupted is picked up again by the next run.
+        if legacy_dir and self.conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            if any(name.endswith(".json") for name in os.listdir(legacy_dir)):
+                print(f"Importing the JSON cache in {legacy_dir} into {path}")
+                import_json_dir(self, legacy_dir)
+            else:
+                self.conn.execute("PRAGMA user_version = 1")
+                self.conn.commit()
+
+    def get_entry(self, key):
+        """Return (serialized JSON, stored_at, meta) for key, or None on a miss."""
+        with self.lock:
+            row = self.conn.execute("SELECT value, stored_at, meta FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, stored_at, meta = row
+        return zlib.decompress(value).decode("utf-8"), stored_at, json.loads(meta) if meta else {}
+
+    def put_raw(self, key, serialized, meta=None):
+        self.put_many_raw([(key, serialized, time.time(), meta)])
+
+    def put_many_raw(self, items):
+        """Store (key, serialized JSON, stored_at, meta) tuples in one transaction."""
+        rows = [
+            (key, zlib.compress(serialized.encode("utf-8")), stored_at, json.dumps(meta) if meta else None)
+            for key, serialized, stored_at, meta in items
+        ]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, stored_at, meta) VALUES (?, ?, ?, ?)", rows
+            )
+            self.conn.commit()
+
+    def touch(self, key, meta=None):
+        """Mark an entry as freshly validated."""
+        with self.lock:
+            if meta:
+                self.conn.execute(
+                    "UPDATE entries SET stored_at = ?, meta = ? WHERE key = ?", (time.time(), json.dumps(meta), key)
+                )
+            else:
+                self.conn.execute("UPDATE entries SET stored_at = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+
+
+STORES = {
+    "json": JsonDirStore,
+    "sqlite": SqliteStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Return the process-wide cache store, opening it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if CACHE_BACKEND not in STORES:
+                raise ValueError(f"Unknown CACHE_BACKEND '{CACHE_BACKEND}', expected one of {list(STORES)}")
+            _store = STORES[CACHE_BACKEND]()
+        return _store
+
+
+class MemoryTier:
+    """
+    A bounded LRU of already-deserialized results, sized by the length of their
+    serialized JSON. Values are shared between callers, so don't mutate them.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (True, value) if key is in memory, (False, None) if not."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True, self.entries[key][0]
+            return False, None
+
+    def put(self, key, value, size):
+        with self.lock:
+            if size > self.max_bytes:
+                return  # would evict everything else; leave it on disk only
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+            }
+
+
+class CacheStats:
+    """How one cached function's lookups went: fresh results from memory or disk, or misses."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"memory": 0, "disk": 0, "miss": 0}
+
+    def record(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+_memory = MemoryTier(MEMORY_CACHE_BYTES)
+
+
+# cache key -> [lock, number of callers holding or waiting on it]
+_flights = {}
+_flights_lock = threading.Lock()
+
+@contextmanager
+def single_flight(cache_key):
+    """Serialize callers computing the same cache key. Re-entrant within a thread."""
+    with _flights_lock:
+        flight = _flights.setdefault(cache_key, [threading.RLock(), 0])
+        flight[1] += 1
+    try:
+        with flight[0]:
+            yield
+    finally:
+        with _flights_lock:
+            flight[1] -= 1
+            if flight[1] == 0:
+                del _flights[cache_key]
+
+
+# Per-thread stack of the entries being computed, so a cached function can
+# attach metadata (e.g. HTTP validators) to its own result, and see the
+# expired result it is replacing.
+_computing = threading.local()
+
+def set_cache_meta(meta):
+    """
+    Called from inside a cached function (or its revalidate function) to store
+    metadata alongside the result it is about to return, e.g. an ETag.
+    """
+    stack = getattr(_computing, "stack", None)
+    if stack:
+        stack[-1]["meta"].update(meta)
+
+def previous_result():
+    """
+    Called from inside a cached function: the expired result it is being
+    recomputed to replace, or None if there isn't one. Lets a function update
+    its old result rather than starting over. Don't mutate it.
+    """
+    stack = getattr(_computing, "stack", None)
+    if stack:
+        return stack[-1]["previous"]
+    return None
+
+@contextmanager
+def _computing_entry(previous=None):
+    if not hasattr(_computing, "stack"):
+        _computing.stack = []
+    frame = {"meta": {}, "previous": previous}
+    _computing.stack.append(frame)
+    try:
+        yield frame["meta"]
+    finally:
+        _computing.stack.pop()
+
+
+# function name -> CacheStats, for reporting
+CACHE_STATS = {}
+
+def cache_stats():
+    """Hit/miss counters of every cached function."""
+    return {name: stats.stats() for name, stats in CACHE_STATS.items()}
+
+def print_cache_stats():
+    for name, stats in sorted(cache_stats().items()):
+        print(f"{name}: {stats['memory']} memory hits | {stats['disk']} disk hits | {stats['miss']} misses")
+    memory = _memory.stats()
+    print(f"memory tier: {memory['entries']} entries ({memory['bytes'] / 1024 / 1024:.1f} MB "
+          f"of {_memory.max_bytes / 1024 / 1024:.0f} MB) | {memory['evictions']} evictions")
+
+
+def content_hash(*parts):
+    """A stable hex digest of some strings, for content-addressed cache keys."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _sanitize(cache_key):
+    return cache_key.replace("/", "_")  # Sanitize filenames
+
+def _legacy_entry(legacy_key):
+    """
+    The entry old code left under legacy_key: in the store, or else still in
+    the JSON cache directory (if it was never imported into the store).
+    """
+    entry = get_store().get_entry(legacy_key)
+    if entry is None and CACHE_BACKEND != "json":
+        entry = JsonDirStore(CACHE_DIR).get_entry(legacy_key)
+    return entry
+
+def has_legacy_entry(legacy_key):
+    """Whether old code left anything under legacy_key (e.g. "describe_body_<key>")."""
+    return _legacy_entry(_sanitize(legacy_key)) is not None
+
+def legacy_value(legacy_key):
+    """The value old code cached under legacy_key, or None."""
+    entry = _legacy_entry(_sanitize(legacy_key))
+    return json.loads(entry[0]) if entry is not None else None
+
+def adopt_legacy_entry(legacy_key, cache_key):
+    """
+    For results that have moved to a new cache key: if cache_key has no entry
+    yet, copy the one stored under legacy_key by the old code, so nothing it
+    already computed is computed again. A legacy entry is only adopted once,
+    so it can't later stand in for a result of newer input.
+    """
+    store = get_store()
+    legacy_key, cache_key = _sanitize(legacy_key), _sanitize(cache_key)
+    if store.get_entry(cache_key) is not None:
+        return
+    entry = _legacy_entry(legacy_key)
+    if entry is None or entry[2].get("adopted"):
+        return
+    serialized, _stored_at, meta = entry
+    print(f"Adopted legacy cache entry {legacy_key} as {cache_key}")
+    store.put_raw(cache_key, serialized)
+    # marked in the store, which is looked at before the JSON directory
+    store.put_raw(legacy_key, serialized, dict(meta, adopted=True))
+
+
+def cache_results(key=None, subkey=None, memory=True, ttl=None, revalidate=None, version=None):
+    """
+    Decorator to cache function results in the configured cache store, with a
+    in-memory LRU in front of it that every cached function shares
+    (memory=False keeps this function's results out of it).
+
+    The cache key is built from all arguments by default, from args[key] (or
+    args[key][subkey]) if key is an index, or from key(*args, **kwargs) if key
+    is a function.
+
+    By default entries never expire. With ttl (in seconds), an older entry is
+    recomputed on its next lookup, or, if revalidate is given, checked with
+    revalidate(meta, *args, **kwargs): it returns NOT_MODIFIED to keep the cached
+    value for another ttl, or the new value to store instead.
+
+    With version, a function of the same arguments (e.g. a hash of the input the
+    result is derived from), an entry stored under a different version is
+    recomputed too, so the result never outlives the input it was made from.
+    """
     def decorator(func):
-        os.makedirs(CACHE_DIR, exist_ok=True)
+        stats = CACHE_STATS.setdefault(func.__name__, CacheStats())
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             if key is None:
                 suffix = f'{args}_{kwargs}'
+            elif callable(key):
+                suffix = key(*args, **kwargs)
             elif subkey is None:
                 suffix = f'{list(args)[key]}'
             else:
                 suffix = f'{list(args)[key][subkey]}'
-            # Generate cache file path based on function name and arguments
-            cache_key = f"{func.__name__}_{suffix}.json"
-            cache_key = cache_key.replace("/", "_")  # Sanitize filenames
-            cache_file = os.path.join(CACHE_DIR, cache_key)
-
-            # Return cached result if available
-            if os.path.exists(cache_file):
-                with open(cache_file, "r") as f:
-                    print(f"Loaded from cache: {cache_key}")
-                    return json.load(f)
-
-            # Call the original function
-            result = func(*args, **kwargs)
-
-            # Save result to cache
-            with open(cache_file, "w") as f:
+            # Generate cache key based on function name and arguments
+            cache_key = _sanitize(f"{func.__name__}_{suffix}")
+            store = get_store()
+
+            def lookup():
+                """
+                Return the cached (value, stored_at, meta), from memory first, or
+                None, and where it came from ("memory" or "disk").
+                """
+                if memory:
+                    hit, entry = _memory.get(cache_key)
+                    if hit:
+                        return entry, "memory"
+
+                entry = store.get_entry(cache_key)
+                if entry is None:
+                    return None, None
+                serialized, stored_at, meta = entry
+                try:
+                    cached = json.loads(serialized)
+                except ValueError:
+                    # a truncated file left behind by an older, non-atomic write
+                    print(f"Ignoring unreadable cache entry: {cache_key}")
+                    return None, None
+                print(f"Loaded from cache: {cache_key}")
+                if memory:
+                    _memory.put(cache_key, (cached, stored_at, meta), len(serialized))
+                return (cached, stored_at, meta), "disk"
+
+            current_version = version(*args, **kwargs) if version is not None else None
+
+            def is_fresh(entry):
+                if version is not None and entry[2].get("version") != current_version:
+                    return False
+                return ttl is None or time.time() - entry[1] < ttl
+
+            def save(result, meta):
+                if version is not None:
+                    meta = dict(meta, version=current_version)
+                # Round-trip through JSON so callers always get the same types
+                # (lists, not tuples) whether or not it was a hit.
                 print(f"Wrote to cache: {cache_key}")
-                json.dump(result, f)
+                serialized = json.dumps(result)
+                store.put_raw(cache_key, serialized, meta)
+                result = json.loads(serialized)
+                if memory:
+                    _memory.put(cache_key, (result, time.time(), meta), len(serialized))
+                return result
+
+            entry, source = lookup()
+            if entry is not None and is_fresh(entry):
+                stats.record(source)
+                return entry[0]
+
+            # Only one caller computes a given key; anyone else asking for it
+            # in the meantime waits here, then finds the result in the cache.
+            with single_flight(cache_key):
+                entry, source = lookup()
+                if entry is not None and is_fresh(entry):
+                    stats.record(source)
+                    return entry[0]
+
+                # missing, or stale: either way it's recomputed (or revalidated)
+                stats.record("miss")
+
+                # a result made from an older version of its input can't be revalidated
+                if entry is not None and revalidate is not None and (version is None or entry[2].get("version") == current_version):
+                    cached, _stored_at, meta = entry
+                    try:
+                        with _computing_entry(cached) as new_meta:
+                            result = revalidate(meta, *args, **kwargs)
+                    except Exception as e:
+                        # serve stale rather than fail the whole run
+                        print(f"Revalidation failed for {cache_key}, using cached copy: {e}")
+                        return cached
 
-            return result
+                    if result is NOT_MODIFIED:
+                        print(f"Revalidated cache: {cache_key}")
+                        if new_meta and version is not None:
+                            new_meta["version"] = current_version
+                        store.touch(cache_key, new_meta)
+                        if memory:
+                            _memory.put(cache_key, (cached, time.time(), new_meta or meta), len(json.dumps(cached)))
+                        return cached
+                    return save(result, new_meta)
+
+                # Call the original function
+                with _computing_entry(entry[0] if entry is not None else None) as new_meta:
+                    result = func(*args, **kwargs)
+                return save(result, new_meta)
 
         return wrapper
     return decorator
+
+
+def migrate_json_dir(source_dir=CACHE_DIR, db_path=CACHE_DB, batch_size=1000):
+    """
+    Import every <key>.json file from a legacy cache directory into a SqliteStore.
+    The JSON files are left in place; delete them once you're happy with the import.
+    A new database does this by itself for the directory it lives in.
+    """
+    import_json_dir(SqliteStore(db_path, legacy_dir=None), source_dir, batch_size)
+
+
+def import_json_dir(store, source_dir, batch_size=1000):
+    names = [name for name in os.listdir(source_dir) if name.endswith(".json")]
+
+    batch = []
+    imported = 0
+    skipped = 0
+    for name in names:
+        path = os.path.join(source_dir, name)
+        with open(path, "r") as f:
+            serialized = f.read()
+        try:
+            json.loads(serialized)
+        except ValueError:
+            # a truncated write from a crashed run; let the next run recompute it
+            skipped += 1
+            continue
+        batch.append((name[:-len(".json")], serialized, os.path.getmtime(path), None))
+        if len(batch) >= batch_size:
+            store.put_many_raw(batch)
+            imported += len(batch)
+            batch = []
+            print(f"Migrated {imported}/{len(names)} cache entries")
+
+    if batch:
+        store.put_many_raw(batch)
+        imported += len(batch)
+
+    with store.lock:
+        store.conn.execute("PRAGMA user_version = 1")  # imported; don't do it again
+        store.conn.commit()
+    print(f"Done! Migrated {imported} entries into {store.path} (skipped {skipped} unreadable files)")
+
+
+if __name__ == '__main__':
+    # usage: python cache.py migrate [source_dir] [db_path]
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: python cache.py migrate [source_dir] [db_path]")
+        sys.exit(1)
+    migrate_json_dir(*sys.argv[2:4])
@@ -1,13 +1,22 @@
 from typing import List, Tuple, Set
 from collections import Counter
 import numpy as np
+import os
 import re
+import json
+import pickle
 
+import sklearn
 from sklearn.model_selection import train_test_split, cross_val_score
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import classification_report, confusion_matrix
 
+from cache import CACHE_DIR, content_hash
+
+# Trained models, one pickle per distinct set of training data.
+MODEL_DIR = os.path.join(CACHE_DIR, "models")
+
 def train_committer_model(
     data: List[Tuple[str, str]],
     terms_to_strip: Set[str] = None,
@@ -114,6 +123,49 @@ def train_committer_model(
     return model, vectorizer, (train_accuracy, test_accuracy, cv_scores, class_report, conf_mat)
 
 
+def load_or_train_committer_model(
+    data: List[Tuple[str, str]],
+    terms_to_strip: Set[str] = None,
+    test_size: float = 0.2,
+    random_state: int = 42
+):
+    """
+    train_committer_model, but the fitted model and vectorizer are saved under
+    a hash of the training data and parameters, and loaded from there on later
+    runs: we only retrain when the data changes. Older models are deleted once
+    a new one is saved.
+    """
+    # sklearn's pickles aren't portable across versions, so the version is part of the key
+    key = content_hash(
+        json.dumps(data),
+        json.dumps(sorted(terms_to_strip or [])),
+        f"{test_size}_{random_state}",
+        sklearn.__version__,
+    )
+    path = os.path.join(MODEL_DIR, f"committer_{key}.pkl")
+
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            model, vectorizer, stats = pickle.load(f)
+        print(f"Loaded committer model {key[:12]} (test accuracy {stats[1]:.4f})")
+        return model, vectorizer, stats
+
+    model, vectorizer, stats = train_committer_model(data, terms_to_strip, test_size, random_state)
+
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((model, vectorizer, stats), f)
+    os.replace(tmp_path, path)
+    print(f"Saved committer model {key[:12]}")
+
+    for name in os.listdir(MODEL_DIR):
+        if name.startswith("committer_") and name.endswith(".pkl") and os.path.join(MODEL_DIR, name) != path:
+            os.remove(os.path.join(MODEL_DIR, name))
+
+    return model, vectorizer, stats
+
+
 def predict_top_committers(
     model, 
     vectorizer, 
@@ -91,6 +91,49 @@ CREATE TABLE contributor_names (
 
 \copy contributor_names FROM 'contributor_names.csv' DELIMITER ',' CSV HEADER;
 
+DROP TABLE IF EXISTS identities cascade;
+
+-- every spelling of a person we've seen, and the integer id they resolve to (see identities.py)
+CREATE TABLE identities (
+    alias text primary key,
+    person_id integer,
+    name text
+);
+
+
+\copy identities FROM 'identities.csv' DELIMITER ',' CSV HEADER;
+
+-- one row per person, named the way contributors and contrib_tf_idf name them
+create or replace view people as 
+    SELECT DISTINCT person_id, normalize_name_email(name) name
+    from identities
+;
+
+-- thread authors and reviewers as person ids, to join against the commit history
+create or replace view thread_stats_people as 
+    SELECT s.*,
+        author.person_id author_person_id,
+        coalesce((
+            SELECT json_agg(reviewer.person_id)
+            from json_array_elements_text(s.reviewer_list) r(alias)
+            join identities reviewer on reviewer.alias = r.alias
+        ), '[]'::json) reviewer_person_ids
+    from thread_stats s
+    left join identities author on author.alias = s.author
+;
+
+-- predicted committers as person ids, to join against the commit history
+create or replace view predicted_committer_people as 
+    SELECT p.*,
+        a.person_id a_person_id,
+        b.person_id b_person_id,
+        c.person_id c_person_id
+    from predicted_committer p
+    left join identities a on a.alias = p.a
+    left join identities b on b.alias = p.b
+    left join identities c on c.alias = p.c
+;
+
 create or replace view contributors as 
     SELECT name display_name, normalize_name_email(name) name
     from contributor_names
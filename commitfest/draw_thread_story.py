@@ -157,10 +157,29 @@ def draw_thread(args):
 
     print("got story for ", thread)
 
+    draw_story((thread, outfile, messages))
+
+
+def draw_story(args):
+    """
+    Draw an already-told story to outfile. Doesn't touch the network or the
+    cache, so it can run in the CPU process pool (run_jobs lane="process").
+    """
+    thread, outfile, messages = args
+
     svg_output = create_thread_svg(messages)
 
     print("got svg ", thread)
 
+    # leave unchanged threads' files alone, so only real updates show up downstream
+    try:
+        with open(outfile, "r") as f:
+            if f.read() == svg_output:
+                print(f"SVG visualization for {thread} is unchanged")
+                return
+    except FileNotFoundError:
+        pass
+
     with open(outfile, "w") as f:
         f.write(svg_output)
 
@@ -0,0 +1,49 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from worker import resource, RESOURCE_LIMITS
+
+# Upper bound on simultaneous requests to postgresql.org, across all threads.
+# Also the pool size, so every in-flight request can reuse a kept-alive connection.
+HTTP_CONCURRENCY = RESOURCE_LIMITS["http"]
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 60))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the shared requests.Session, creating it on first use. It keeps
+    connections alive between calls, so we only pay for the TCP/TLS
+    handshake once per connection rather than once per page.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retries = Retry(
+                total=3,
+                backoff_factor=1,
+                status_forcelist=[429, 502, 503, 504],
+                allowed_methods=["GET"],
+            )
+            adapter = HTTPAdapter(
+                pool_connections=4,  # one pool per host: www., commitfest. and the bare domain
+                pool_maxsize=HTTP_CONCURRENCY,
+                max_retries=retries,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def http_get(url, **kwargs):
+    """requests.get through the shared session, limited to HTTP_CONCURRENCY at a time."""
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    with resource("http"):
+        return get_session().get(url, **kwargs)
@@ -0,0 +1,234 @@
+import os
+import re
+import json
+import unicodedata
+
+from cache import CACHE_DIR
+
+IDENTITIES_PATH = os.environ.get("IDENTITIES_PATH", os.path.join(CACHE_DIR, "identities.json"))
+
+# The repo history store analyze_repo.py writes (see history_store.py), where
+# ingest_table_stats.sql reads it from.
+REPO_HISTORY_PATH = os.environ.get("REPO_HISTORY_PATH", "repo_history")
+
+# What analyze_repo.extract_commit_associations puts in when a trailer has no email.
+NO_EMAIL = 'no_email@none.com'
+
+
+def normalize_name(raw):
+    """
+    The same normalization as normalize_name_email() in normalize_author_names.sql,
+    so keys built here line up with names normalized in the database.
+    """
+    # 1) Strip out "Author: " if present
+    step = re.sub(r'Author:', '', raw, flags=re.IGNORECASE)
+    # 2) Remove any angle-bracketed text, e.g. emails
+    step = re.sub(r'<[^>]+>', '', step)
+    # 3) Remove any parenthetical remarks, e.g. "(Fujitsu)"
+    step = re.sub(r'\(.*?\)', ' ', step)
+    # 4) Convert accented characters to unaccented forms
+    step = ''.join(c for c in unicodedata.normalize('NFKD', step) if not unicodedata.combining(c))
+    # 5) Normalize spacing
+    step = re.sub(r'\s+', ' ', step).strip()
+    # 6) "Lastname, First" -> "First Lastname"
+    if re.match(r'^[^,]+,[^,]+$', step):
+        last, first = re.split(r'\s*,\s*', step)
+        step = re.sub(r'\s+', ' ', f'{first} {last}').strip()
+    # 7) Remove single-letter words (middle initials), and initcap() the rest
+    words = []
+    for word in step.split(' '):
+        if len(re.sub(r'\W', '', word)) == 1:
+            continue
+        words.append(re.sub(r'[^\W_]+', lambda m: m.group(0)[0].upper() + m.group(0)[1:].lower(), word))
+    # 8) Final space cleanup
+    return re.sub(r'\s+', ' ', ' '.join(words)).strip()
+
+
+def normalize_email(raw):
+    """Lowercase, and undo the mailing list's "andres(at)anarazel(dot)de" obfuscation."""
+    email = raw.strip().lower().replace('(at)', '@').replace('(dot)', '.')
+    email = re.sub(r'\s+', '', email)
+    return email if '@' in email and email != NO_EMAIL else ''
+
+
+def parse_alias(raw):
+    """
+    Split any of the ways people show up into (display name, email or ''):
+      'Andres Freund <andres@anarazel.de>'                  (git, trailers)
+      '"Hayato Kuroda (Fujitsu)" <kuroda(dot)hayato(at)fujitsu(dot)com>'  (mailing list)
+      'Hayato Kuroda (Fujitsu)'                             (thread headers, commitfest)
+    """
+    match = re.match(r'^\s*"?([^"<]*?)"?\s*<([^>]*)>\s*$', raw)
+    if match:
+        return match.group(1).strip(), normalize_email(match.group(2))
+    return raw.strip(), ''
+
+
+# Bumped when saved tables can't be reused as they are (and get rebuilt from scratch).
+IDENTITIES_VERSION = 2
+
+
+class IdentityTable:
+    """
+    Clusters the aliases a person goes by (names in their different spellings,
+    and email addresses) into one integer person id, with at most one email
+    per person.
+
+    An email always identifies its person. A name only links an alias to a
+    cluster if it's at least two words long (normalize_name drops initials, so
+    "Peter E" and "Peter G" are both just "Peter") and the alias doesn't have
+    a different email than the cluster: a git trailer with both a name and an
+    email links that name to that email, but two emails are never merged on a
+    name alone. A name shared by people with different emails stays with the
+    first of them.
+
+    Ids are stable: loading the table and adding more aliases keeps the ids it
+    already handed out (when two clusters turn out to be one, the lower id wins).
+    """
+
+    def __init__(self, keys=None, names=None, next_id=None, emails=None):
+        self.keys = keys or {}  # "name:<normalized>" / "email:<normalized>" -> person id
+        self.names = names or {}  # person id -> display name, as first seen
+        self.emails = emails or {}  # person id -> its "email:<normalized>" key
+        # never reuse the id of a cluster that was merged away
+        self.next_id = next_id if next_id is not None else max(self.names, default=-1) + 1
+
+    @staticmethod
+    def _keys_of(raw):
+        """(display name, email key or None, name key or None) of an alias."""
+        name, email = parse_alias(raw)
+        normalized = normalize_name(name)
+        email_key = f'email:{email}' if email else None
+        name_key = f'name:{normalized}' if normalized else None
+        if email_key and len(normalized.split(' ')) < 2:
+            name_key = None  # too ambiguous to link this email to anyone else
+        return name, email_key, name_key
+
+    def add(self, raw):
+        """Record an alias, merging clusters it connects, and return its person id (None if it has no usable name or email)."""
+        name, email_key, name_key = self._keys_of(raw)
+        if not email_key and not name_key:
+            return None
+
+        email_id = self.keys.get(email_key) if email_key else None
+        name_id = self.keys.get(name_key) if name_key else None
+        if name_id is not None and email_key and self.emails.get(name_id, email_key) != email_key:
+            name_id = None  # the name is taken by someone with another email
+
+        ids = {person_id for person_id in (email_id, name_id) if person_id is not None}
+        if not ids:
+            person_id = self.next_id
+            self.next_id += 1
+            self.names[person_id] = name or (email_key or name_key).split(':', 1)[1]
+        else:
+            person_id = min(ids)
+            merged = ids - {person_id}
+            if merged:
+                for key, key_id in self.keys.items():
+                    if key_id in merged:
+                        self.keys[key] = person_id
+                for merged_id in merged:
+                    del self.names[merged_id]
+                    if merged_id in self.emails:
+                        self.emails[person_id] = self.emails.pop(merged_id)
+
+        if email_key:
+            self.keys[email_key] = person_id
+            self.emails[person_id] = email_key
+        if name_key and name_key not in self.keys:
+            self.keys[name_key] = person_id
+        return person_id
+
+    def resolve(self, raw):
+        """The person id of an alias, or None if it's not in the table. Aliases with an email match on it alone."""
+        _name, email_key, name_key = self._keys_of(raw)
+        return self.keys.get(email_key or name_key)
+
+    def name_of(self, person_id):
+        return self.names.get(person_id)
+
+    def check(self):
+        """Raise ValueError if any person ended up with more than one email."""
+        emails = {}
+        for key, person_id in self.keys.items():
+            if key.startswith('email:'):
+                emails.setdefault(person_id, []).append(key.split(':', 1)[1])
+        clashes = {person_id: found for person_id, found in emails.items() if len(found) > 1}
+        if clashes:
+            examples = '; '.join(f"{self.names.get(person_id)}: {', '.join(found)}" for person_id, found in list(clashes.items())[:5])
+            raise ValueError(f"{len(clashes)} people have several emails, e.g. {examples}")
+
+    def save(self, path=IDENTITIES_PATH):
+        self.check()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": IDENTITIES_VERSION, "keys": self.keys, "names": self.names, "emails": self.emails, "next_id": self.next_id}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=IDENTITIES_PATH):
+        """The table saved at path, or an empty one."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != IDENTITIES_VERSION:
+            # older tables merged people on a shared name alone, so their
+            # clusters can't be trusted
+            print(f"{path} was built by an older version, rebuilding it")
+            return cls()
+        return cls(
+            data["keys"],
+            {int(person_id): name for person_id, name in data["names"].items()},
+            data["next_id"],
+            {int(person_id): email for person_id, email in data["emails"].items()},
+        )
+
+
+def history_aliases(path=REPO_HISTORY_PATH):
+    """
+    Everyone in the repo history store at path, as the "name <email>" of each
+    commit author and trailer. Only the store's people dictionary is read, not
+    the rows. [] if there's no store yet.
+    """
+    manifest_path = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest_path):
+        print(f"No repo history at {path}, resolving identities without it")
+        return []
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    # chunks past committed_chunks are from an unfinished run, and so are
+    # people past the count of the last committed one
+    chunks = manifest["chunks"][:manifest.get("committed_chunks", len(manifest["chunks"]))]
+    if not chunks:
+        return []
+    if "people" not in chunks[-1]:
+        print(f"Repo history at {path} predates people.jsonl, rerun analyze_repo.py to use it; resolving identities without it")
+        return []
+
+    people = []
+    with open(os.path.join(path, "people.jsonl"), "r", encoding="utf-8") as f:
+        for line in f:
+            if len(people) == chunks[-1]["people"]:
+                break
+            people.append(json.loads(line))
+    return people
+
+
+def resolve_identities(aliases, path=IDENTITIES_PATH):
+    """
+    Add aliases to the persisted identity table. Returns {alias: person id} for
+    every one of them (aliases with neither a name nor an email are left out),
+    and the table, for looking up display names.
+    """
+    table = IdentityTable.load(path)
+    for alias in aliases:
+        table.add(alias)
+    table.save(path)
+
+    resolved = {alias: table.resolve(alias) for alias in set(aliases)}
+    resolved = {alias: person_id for alias, person_id in resolved.items() if person_id is not None}
+    print(f"Resolved {len(resolved)} aliases to {len(set(resolved.values()))} people")
+    return resolved, table
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+from collections import Counter
+
+from cache import CACHE_DIR
+from worker import stream_jobs
+
+JOURNAL_DIR = os.path.join(CACHE_DIR, "journal")
+
+
+class JobJournal:
+    """
+    An append-only log of the items of one long-running batch, in
+    .cache/journal/<name>.jsonl. Each line records an item as pending, done
+    (with its result) or failed (with the error class and message), along with
+    the version of the item's input it was run on; the last line for an item
+    wins. Lines are flushed as they're written, so a crash loses at most the
+    item in progress.
+    """
+
+    def __init__(self, name, directory=JOURNAL_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.name = name
+        self.path = os.path.join(directory, f"{name}.jsonl".replace("/", "_"))
+        self.entries = {}  # json.dumps(key) -> latest record
+        self._load()
+        self._file = open(self.path, "a")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # the half-written last line of a crashed run
+                self.entries[json.dumps(record["key"])] = record
+
+    def _write(self, record):
+        self.entries[json.dumps(record["key"])] = record
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def _record(self, key, version=None):
+        """The latest record for key, if it was made from this version of the input."""
+        record = self.entries.get(json.dumps(key))
+        if record is None or record.get("version") != version:
+            return None
+        return record
+
+    def status(self, key, version=None):
+        record = self._record(key, version)
+        return record["status"] if record else None
+
+    def result(self, key):
+        return self.entries[json.dumps(key)]["result"]
+
+    def attempts(self, key, version=None):
+        """How many times the item has failed, across runs, on this version of its input."""
+        record = self._record(key, version)
+        return record.get("attempts", 0) if record else 0
+
+    def error(self, key):
+        return self.entries[json.dumps(key)]["error"]
+
+    def pending(self, key, version=None):
+        self._write({"key": key, "status": "pending", "version": version})
+
+    def done(self, key, result, version=None):
+        self._write({"key": key, "status": "done", "result": result, "version": version})
+
+    def failed(self, key, error, version=None):
+        self._write({
+            "key": key,
+            "status": "failed",
+            "version": version,
+            "error_class": type(error).__name__,
+            "error": str(error),
+            "attempts": self.attempts(key, version) + 1,
+        })
+
+    def summary(self):
+        """Counts of items by status, and of failures by error class."""
+        statuses = Counter(record["status"] for record in self.entries.values())
+        error_classes = Counter(record["error_class"] for record in self.entries.values() if record["status"] == "failed")
+        return {"statuses": dict(statuses), "error_classes": dict(error_classes)}
+
+    def print_summary(self):
+        summary = self.summary()
+        statuses = summary["statuses"]
+        print(f"Journal {self.name}: {statuses.get('done', 0)} done, {statuses.get('failed', 0)} failed, {statuses.get('pending', 0)} pending")
+        for error_class, count in Counter(summary["error_classes"]).most_common():
+            print(f"  {error_class}: {count}")
+
+    def close(self):
+        self._file.close()
+
+
+class _Failure:
+    """What a journaled job returns instead of raising, so the journal sees the exception itself."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _catching(fn):
+    def attempt(args):
+        try:
+            return fn(args)
+        except Exception as e:
+            return _Failure(e)
+    return attempt
+
+
+def run_journaled_jobs(name, fn, payloads, max_workers=5, payload_arg_key_fn=None, version_fn=None, retries=3, backoff=5, max_attempts=8):
+    """
+    Like run_jobs, but every finished item is recorded in the journal `name`,
+    so a batch that crashes or is interrupted picks up where it left off: items
+    already done are returned from the journal without running fn again.
+
+    version_fn(payload) gives a version of an item's input (e.g. a hash of a
+    thread's text); an item whose input has changed since it was journaled is
+    run again. Keys and versions must be JSON-serializable.
+
+    Failed items are retried up to `retries` more times, waiting backoff,
+    2*backoff, 4*backoff... seconds between rounds, and again on later runs,
+    until they've failed max_attempts times in all on the same input. After
+    that they're given up on until their input changes. Items that fail come
+    back as {"error": ...} like in run_jobs.
+
+    Delete .cache/journal/<name>.jsonl to start over.
+    """
+    key_of = payload_arg_key_fn if payload_arg_key_fn else lambda x: x
+    version_of = version_fn if version_fn else lambda x: None
+    journal = JobJournal(name)
+
+    results = {}
+    versions = {}
+    todo = []
+    given_up = 0
+    for payload in payloads:
+        key = key_of(payload)
+        versions[json.dumps(key)] = version = version_of(payload)
+        status = journal.status(key, version)
+        if status == "done":
+            results[key] = journal.result(key)
+        elif status == "failed" and journal.attempts(key, version) >= max_attempts:
+            results[key] = {"error": journal.error(key)}
+            given_up += 1
+        else:
+            if status is None:
+                journal.pending(key, version)
+            todo.append(payload)
+
+    print(f"Journal {name}: {len(results) - given_up} items already done, {given_up} given up on, {len(todo)} to run")
+
+    attempt = _catching(fn)
+    failures = {}
+    for retry in range(retries + 1):
+        if retry > 0:
+            delay = backoff * 2 ** (retry - 1)
+            print(f"Journal {name}: retrying {len(todo)} failed items in {delay}s")
+            time.sleep(delay)
+
+        for key, result in stream_jobs(attempt, todo, max_workers, payload_arg_key_fn):
+            version = versions[json.dumps(key)]
+            if isinstance(result, _Failure):
+                journal.failed(key, result.error, version)
+                failures[key] = result.error
+            else:
+                journal.done(key, result, version)
+                results[key] = result
+                failures.pop(key, None)
+
+        todo = [
+            payload for payload in todo
+            if key_of(payload) in failures and journal.attempts(key_of(payload), versions[json.dumps(key_of(payload))]) < max_attempts
+        ]
+        if not todo:
+            break
+
+    for key, error in failures.items():
+        results[key] = {"error": str(error)}
+
+    journal.print_summary()
+    journal.close()
+    return results
+
+
+if __name__ == '__main__':
+    # usage: python journal.py <name>
+    if len(sys.argv) != 2:
+        print("usage: python journal.py <name>")
+        sys.exit(1)
+    journal = JobJournal(sys.argv[1])
+    journal.print_summary()
+    journal.close()
@@ -1,42 +1,169 @@
 from dotenv import load_dotenv
 import requests
 import os
-from time import sleep
+from time import sleep, monotonic
 from random import random
 import re
 import json
+import threading
+
+from cache import cache_results, content_hash, adopt_legacy_entry
+from worker import RESOURCE_LIMITS
 
 load_dotenv()
 
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.0-flash")
+
+
+def prompt_gemini(prompt, as_json=False, model=GEMINI_MODEL, legacy_key=None):
+    """
+    Send a prompt to Gemini and return the text of its answer (parsed with
+    clean_gemini_json if as_json). Results are cached on a hash of the prompt
+    and model, so the same prompt is only ever sent once, whichever function
+    builds it.
+
+    legacy_key is where the calling function cached this answer itself before
+    answers were cached on the prompt; if the prompt has never been sent, that
+    answer is used (once) instead of asking again.
+    """
+    prompt_hash = content_hash(model, as_json, prompt)
+    if legacy_key is not None:
+        adopt_legacy_entry(legacy_key, f"cached_prompt_{prompt_hash}")
+    return cached_prompt(prompt_hash, prompt, as_json, model)
+
+
+@cache_results(0)
+def cached_prompt(prompt_hash, prompt, as_json, model): # prompt_hash argument used for cacheing
+    result = request_gemini(prompt, model)
+    if not as_json:
+        return result
+
+    try:
+        return clean_gemini_json(result)
+    except ValueError:
+        # raising keeps the unparseable answer out of the cache
+        print(result)
+        raise ValueError("Unable to parse LLM response as JSON")
+
+
+class RateLimiter:
+    """
+    Shared by every thread that calls Gemini. Keeps us under requests/min and
+    tokens/min budgets (token buckets that refill continuously), and limits how
+    many requests are in flight at once. That limit adapts: it halves whenever
+    we get a 429 and creeps back up by one after a run of successes.
+    """
+
+    def __init__(self, requests_per_min, tokens_per_min, max_concurrency):
+        self.rpm = requests_per_min
+        self.tpm = tokens_per_min
+        self.max_concurrency = max_concurrency
+        self.concurrency = max(1, max_concurrency // 2)
+        self.request_budget = float(requests_per_min)
+        self.token_budget = float(tokens_per_min)
+        self.refilled_at = monotonic()
+        self.in_flight = 0
+        self.successes = 0
+        self.throttled = 0
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = monotonic()
+        elapsed = now - self.refilled_at
+        self.refilled_at = now
+        self.request_budget = min(self.rpm, self.request_budget + elapsed * self.rpm / 60)
+        self.token_budget = min(self.tpm, self.token_budget + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens):
+        # a prompt bigger than a whole minute's budget can go once the bucket is full
+        tokens = min(tokens, self.tpm)
+        with self.cond:
+            while True:
+                self._refill()
+                if self.in_flight < self.concurrency and self.request_budget >= 1 and self.token_budget >= tokens:
+                    self.request_budget -= 1
+                    self.token_budget -= tokens
+                    self.in_flight += 1
+                    return
+                if self.in_flight < self.concurrency:
+                    # waiting on a budget: sleep until enough of it has refilled
+                    wait = max((1 - self.request_budget) * 60 / self.rpm, (tokens - self.token_budget) * 60 / self.tpm)
+                    self.cond.wait(timeout=max(wait, 0.01))
+                else:
+                    self.cond.wait()
 
-def prompt_gemini(prompt, attempt=0):
+    def release(self, throttled=False, estimated_tokens=0, used_tokens=None):
+        with self.cond:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                # settle up the estimate against what the API says we used
+                self.token_budget -= used_tokens - min(estimated_tokens, self.tpm)
+            if throttled:
+                self.throttled += 1
+                self.successes = 0
+                self.concurrency = max(1, self.concurrency // 2)
+                print(f"Rate limited by Gemini; concurrency now {self.concurrency}")
+            else:
+                self.successes += 1
+                if self.successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self.successes = 0
+                    self.concurrency += 1
+            self.cond.notify_all()
+
+
+LIMITER = RateLimiter(
+    requests_per_min=int(os.environ.get("GEMINI_RPM", 2000)),
+    tokens_per_min=int(os.environ.get("GEMINI_TPM", 4000000)),
+    max_concurrency=RESOURCE_LIMITS["llm"],
+)
+
+MAX_ATTEMPTS = 10
+
+
+def estimate_tokens(prompt):
+    # roughly 4 characters per token, plus some room for the answer
+    return len(prompt) // 4 + 500
+
+
+def request_gemini(prompt, model=GEMINI_MODEL):
     api_key = os.environ.get("GEMINI_API_KEY")
     if not api_key:
         raise ValueError("Must provide GEMINI_API_KEY env variable")
    
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
-   
-    req = requests.post(url, 
-        json={
-        "contents": [{
-             "parts":[{"text": prompt}]
-            }]
-        }, 
-        headers={ 'Content-Type': 'application/json' }
-    ).json()
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
+    estimated_tokens = estimate_tokens(prompt)
 
-    try:
-        ans = req["candidates"][0]["content"]["parts"][0]["text"] # I try not to design schemas, but when I do, I hide the actual result six levels deep.
-    except Exception as e:
-        if attempt < 10 and 'error' in req and 'code' in req['error'] and req['error']['code'] == 429:
+    for attempt in range(MAX_ATTEMPTS):
+        LIMITER.acquire(estimated_tokens)
+        throttled = False
+        used_tokens = None
+        try:
+            req = requests.post(url, 
+                json={
+                "contents": [{
+                     "parts":[{"text": prompt}]
+                    }]
+                }, 
+                headers={ 'Content-Type': 'application/json' }
+            ).json()
+            throttled = 'error' in req and req['error'].get('code') == 429
+            used_tokens = req.get('usageMetadata', {}).get('totalTokenCount')
+        finally:
+            LIMITER.release(throttled, estimated_tokens, used_tokens)
+
+        if throttled:
             # backoff
             print(f"Retrying try #{attempt + 1}")
             sleep(5 * random() * 2**attempt )
-            return prompt_gemini(prompt, attempt + 1)
-        else:
+            continue
+
+        try:
+            return req["candidates"][0]["content"]["parts"][0]["text"] # I try not to design schemas, but when I do, I hide the actual result six levels deep.
+        except Exception as e:
             print("XX", "attempt=", attempt, "prompt len=", len(prompt), req) # for debugging
             raise e
-    return ans
+
+    raise ValueError(f"Gave up after {MAX_ATTEMPTS} rate-limited attempts")
 
 
 # Gemini loves wrapping its JSON in a "```json ```", no matter what we tell it, so try stripping this out if it's present.
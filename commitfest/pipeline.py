@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import json
+
+from cache import get_store, content_hash
+from worker import run_jobs
+
+
+class Pipeline:
+    """
+    A DAG of named stages. Each stage is a function taking a dict of the
+    results of the stages it depends on, and starts as soon as those have
+    finished, so independent stages overlap.
+    """
+
+    def __init__(self):
+        self.stages = {}  # name -> (fn, deps)
+
+    def stage(self, name, deps=()):
+        """Decorator registering fn as a stage."""
+        def decorator(fn):
+            self.stages[name] = (fn, tuple(deps))
+            return fn
+        return decorator
+
+    def run(self, max_parallel=4):
+        for name, (_fn, deps) in self.stages.items():
+            unknown = [dep for dep in deps if dep not in self.stages]
+            if unknown:
+                raise ValueError(f"Stage '{name}' depends on unknown stages {unknown}")
+
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            while pending or running:
+                for name, (fn, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        print(f"Stage started: {name}")
+                        running[executor.submit(fn, {dep: results[dep] for dep in deps})] = name
+                        del pending[name]
+
+                if not running:
+                    raise ValueError(f"Stages {list(pending)} depend on each other")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    print(f"Stage finished: {name}")
+
+        return results
+
+
+def _item_key(stage, key):
+    return f"pipeline_{stage}_{key}".replace("/", "_")  # Sanitize filenames
+
+def load_item(stage, key):
+    """The {"version", "output"} recorded for an item of a stage on an earlier run, or None."""
+    entry = get_store().get_entry(_item_key(stage, key))
+    if entry is None:
+        return None
+    return json.loads(entry[0])
+
+def save_item(stage, key, version, output):
+    get_store().put_raw(_item_key(stage, key), json.dumps({"version": version, "output": output}))
+
+
+def version_of(value):
+    """A version string for any JSON-serializable value, e.g. an upstream stage's output."""
+    return content_hash(json.dumps(value, sort_keys=True))
+
+
+def run_dirty_jobs(stage, fn, payloads, version_fn, max_workers=5, payload_arg_key_fn=None, lane="thread"):
+    """
+    Like run_jobs, but only runs fn on payloads whose version (from
+    version_fn(payload)) differs from the one recorded the last time this stage
+    ran; everything else gets its recorded output back. Failed items aren't
+    recorded, so they are retried next time, as are items whose version is None.
+    """
+    key_of = payload_arg_key_fn if payload_arg_key_fn else lambda x: x
+
+    results = {}
+    dirty = []
+    versions = {}
+    for payload in payloads:
+        key = key_of(payload)
+        versions[key] = version_fn(payload)
+        recorded = load_item(stage, key)
+        if versions[key] is not None and recorded is not None and recorded["version"] == versions[key]:
+            results[key] = recorded["output"]
+        else:
+            dirty.append(payload)
+
+    print(f"Stage {stage}: {len(dirty)}/{len(payloads)} items changed")
+
+    fresh = run_jobs(fn, dirty, max_workers=max_workers, payload_arg_key_fn=payload_arg_key_fn, lane=lane)
+    for key, output in fresh.items():
+        if not (isinstance(output, dict) and "error" in output):
+            save_item(stage, key, versions[key], output)
+        results[key] = output
+
+    return results
@@ -1,12 +1,15 @@
 from repo import get_threads_of_last_n_commits
-from analyze_thread import parse_thread, summarize_thread_for_predicting_committer
-from committer_model import train_committer_model, predict_top_committers
+from scrape import parse_thread
+from analyze_thread import summarize_thread_for_predicting_committer
+from committer_model import train_committer_model, load_or_train_committer_model, predict_top_committers
 from distribute_committers import fair_committer_assignments
 
 from random import shuffle, seed
 
-from cache import cache_results
-from worker import run_jobs
+from cache import cache_results, content_hash
+from worker import run_jobs, stream_jobs
+from journal import run_journaled_jobs
+from fetch import HTTP_CONCURRENCY
 
 from collections import Counter
 
@@ -20,12 +23,14 @@ def get_valid_repo_threads(repo, commits):
 
     # 2. fetch threads
     message_ids = [t["thread"] for t in commit_and_thread]
-    # this will fetch a cache that includes the text of the thread
-    threads = run_jobs(parse_thread, message_ids, max_workers=5) # hopefully won't get throttled at this low rate
-
-    # simply discard threads that failed because of a 404 or other reason
-    valid_threads = {thread: results[0] for thread, results in threads.items() if 'error' not in results}
-    print(f"Success rate in threads: {len(valid_threads)}/{len(threads)} ({round(100 * len(valid_threads)/len(threads))}%).")
+    # this will fetch a cache that includes the text of the thread.
+    # Stream the results so we only hold on to the text of each thread.
+    valid_threads = {}
+    for thread, results in stream_jobs(parse_thread, message_ids, max_workers=HTTP_CONCURRENCY): # fetch.py caps requests to the site
+        # simply discard threads that failed because of a 404 or other reason
+        if 'error' not in results:
+            valid_threads[thread] = results[0]
+    print(f"Success rate in threads: {len(valid_threads)}/{len(message_ids)} ({round(100 * len(valid_threads)/len(message_ids))}%).")
     
     return [[
         text,
@@ -33,7 +38,9 @@ def get_valid_repo_threads(repo, commits):
         thread
     ] for thread, text in valid_threads.items()]
 
-@cache_results()
+# Not cached itself: the journal below already keeps every summary, and
+# caching this would also keep the threads that failed out of the training
+# data for good, instead of retrying them on the next run.
 def prepare_committer_training_data():
     threads = get_valid_repo_threads('~/postgres/postgres', 10000)
 
@@ -58,18 +65,24 @@ def prepare_committer_training_data():
     # start with just a little data
     # threads_by_active_committers = threads_by_active_committers[:1000]
 
-    # now, summarize the threads.
-    summarized_threads = run_jobs(
+    # now, summarize the threads. This takes hours, so journal it: a crashed
+    # run resumes where it stopped instead of starting over.
+    summarized_threads = run_journaled_jobs(
+        "committer_training_summaries",
         summarize_thread_for_predicting_committer, 
         threads_by_active_committers,
-        max_workers=4,
-        payload_arg_key_fn= lambda x: x[2]
+        max_workers=16,
+        payload_arg_key_fn= lambda x: x[2],
+        version_fn= lambda x: content_hash(x[0])  # re-summarize threads that got new replies
     )
 
     for thread_id, summary in summarized_threads.items():
         print(thread_id, summary)
 
-    training_data = [(summarized_threads[thread], committer) for _text, committer, thread in threads_by_active_committers ]
+    failed = {thread for thread, summary in summarized_threads.items() if isinstance(summary, dict) and 'error' in summary}
+    print(f"Leaving out {len(failed)} threads that could not be summarized")
+
+    training_data = [(summarized_threads[thread], committer) for _text, committer, thread in threads_by_active_committers if thread not in failed]
 
     return training_data
 
@@ -87,15 +100,16 @@ def predict_committers(thread_ids):
     # is downloaded and cached - but boy, that takes a while!
     print("Getting data to train commiitter prediction model...")
     seed("foo")
-    training_data = prepare_committer_training_data()
+    training_data = list(prepare_committer_training_data()) # cached results are shared, so shuffle a copy
     base_rates = committer_base_rates()
 
     shuffle(training_data)
     print("Training committer prediction model...")
-    model, vectorizer, _stats = train_committer_model(training_data)
+    # reuses the model from an earlier run when the training data hasn't changed
+    model, vectorizer, _stats = load_or_train_committer_model(training_data)
 
     print("Downloading threads for committer model...")
-    threads = run_jobs(parse_thread, thread_ids, max_workers=5)
+    threads = run_jobs(parse_thread, thread_ids, max_workers=HTTP_CONCURRENCY)
     threads_flat = [[
         text,
         None, # this holds the committer in training, but of course we don't this here,
@@ -107,8 +121,7 @@ def predict_committers(thread_ids):
     summarized_threads = run_jobs(
         summarize_thread_for_predicting_committer, 
         threads_flat,
-        max_workers=4, # we're trying to stay under 4 million tokens/min, but not too far under.
-                       # this seems experimentally to be a good setting. 
+        max_workers=16, # llm.LIMITER keeps us under the tokens/min quota
         payload_arg_key_fn= lambda x: x[2]
     )
 
@@ -146,7 +159,7 @@ def predict_committers(thread_ids):
 
 def main():
     seed("foo")
-    training_data = prepare_committer_training_data()
+    training_data = list(prepare_committer_training_data())
 
     base_rates = committer_base_rates()
 
@@ -1,92 +1,78 @@
-import requests
 from bs4 import BeautifulSoup
+import os
 import re
-from cache import cache_results
+from cache import cache_results, set_cache_meta, content_hash, NOT_MODIFIED
+from fetch import http_get
+from thread_parser import parse_thread_html, PARSED_THREAD_VERSION
+from worker import run_in_process
+from pipeline import version_of
+
+# How long a scraped page is trusted before we check it for changes.
+PAGE_TTL = float(os.environ.get("PAGE_TTL_HOURS", 24)) * 3600
+
+
+def _get_page(url, meta=None):
+    """
+    GET a page, making it a conditional request if meta holds validators from a
+    previous response. Records the new validators on the cache entry.
+    """
+    headers = {}
+    if meta and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = http_get(url, headers=headers)
+    if response.status_code != 304:
+        set_cache_meta({
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        })
+    return response
+
 
 # Scraping the mailing list 
-@cache_results()
-def fetch_thread(id):
+def _get_thread_page(id, meta=None):
     url = f'https://www.postgresql.org/message-id/flat/{id}'
 
-    response = requests.get(url)
+    response = _get_page(url, meta)
+    if response.status_code == 304:
+        return NOT_MODIFIED
     if response.status_code != 200:
         err = f"Failed to fetch the page for {id}: {response.status_code}"
         raise ValueError(err)
 
     return response.text
 
-@cache_results()
-def parse_thread(id):
-    text = fetch_thread(id)
-    soup = BeautifulSoup(text, "html.parser")
-
-    main_text_id = 'pgContentWrap'
-    
-    # Find the div with the given id name
-    div = soup.find("div", id=main_text_id)
-    
-    if div:
-        text = div.get_text(separator="\n", strip=True)  # Extracts all text recursively
-    else:
-        raise ValueError(f"No div with id '{id}' found.")
-    
-    attachment_tables = soup.find_all("table", class_="message-attachments")
-
-    if attachment_tables:
-        # 2. Select the last table
-        last_table = attachment_tables[-1]
-        
-        # 3. Find all <a> tags (with href) in this table
-        anchors = last_table.find_all("a", href=True)
-
-        links = [anchor["href"] for anchor in anchors]
-    else:
-        links = []
-
-    from_and_date_list = _helper_extract_from_and_date(soup)
-
-    return text, links, from_and_date_list
-
-def _helper_extract_from_and_date(soup):
+@cache_results(ttl=PAGE_TTL, revalidate=lambda meta, id: _get_thread_page(id, meta))
+def fetch_thread(id):
+    return _get_thread_page(id)
+
+# The parsed form of a thread, produced once per fetch and shared by every stage
+# (see parse_thread_html for its fields). The version is part of the cache key,
+# so bumping PARSED_THREAD_VERSION re-parses everything from the cached HTML.
+@cache_results(lambda id: f'v{PARSED_THREAD_VERSION}_{id}', ttl=PAGE_TTL)
+def get_parsed_thread(id):
+    html = fetch_thread(id)
+    parsed = run_in_process(parse_thread_html, html)
+    parsed["version"] = PARSED_THREAD_VERSION
+    parsed["thread_id"] = id
+    parsed["content_hash"] = content_hash(PARSED_THREAD_VERSION, html)
+    return parsed
+
+def parsed_thread_version(id):
     """
-    Given a BeautifulSoup object of the entire HTML document,
-    find all message-header tables and extract the From name and Date
-    from each table. Returns a list of tuples: [(from_name, date_str), ...].
+    Changes whenever the parsed record of a thread does: the hash stored in it
+    when it was parsed, so checking it costs no more than looking the record up.
     """
+    parsed = get_parsed_thread(id)
+    # records parsed before content_hash was stored in them
+    return parsed.get("content_hash") or version_of(parsed)
 
-    def parse_email_header(table):
-        """
-        Given a BeautifulSoup <table> containing an email header,
-        return a tuple (from_name, date_str).
-        """
-        from_th = table.find('th', string='From:')
-        from_td = from_th.find_next('td') if from_th else None
-        from_text = from_td.get_text(strip=True) if from_td else ""
-
-        # Extract the name from something like:
-        #   "\"Hayato Kuroda (Fujitsu)\" <kuroda(dot)hayato(at)fujitsu(dot)com>"
-        match = re.match(r'^"([^"]+)"', from_text)
-        if match:
-            from_name = match.group(1)
-        else:
-            # If no quotes found, split at '<'
-            from_name = from_text.split('<')[0].strip()
-
-        date_th = table.find('th', string='Date:')
-        date_td = date_th.find_next('td') if date_th else None
-        date_str = date_td.get_text(strip=True) if date_td else ""
-
-        return (from_name, date_str)
-
-    results = []
-
-    tables = soup.find_all('table', class_='table-sm table-responsive message-header')
-    for t in tables:
-        info = parse_email_header(t)
-        if len(info[0]):
-            results.append(info)
-    return results
+def parse_thread(id):
+    parsed = get_parsed_thread(id)
 
+    return parsed["text"], parsed["attachment_links"], parsed["from_and_date"]
 
 
 def _helper_extract_attachment_links(text):
@@ -107,7 +93,7 @@ def _helper_extract_attachment_links(text):
 
 # Scraping the commitfest page
 def parse_commitfest_page(url):
-    response = requests.get(url)
+    response = http_get(url)
     response.raise_for_status()  # Raise an error for bad responses
 
 
@@ -135,22 +121,36 @@ def parse_commitfest_page(url):
     return ids, authors
 
 # Scraping the Patch page
-@cache_results()
-def get_patch_info(patch_id):
+def _get_patch_info(patch_id, meta=None):
     url = f'https://commitfest.postgresql.org/patch/{patch_id}/'
-    response = requests.get(url)
+    response = _get_page(url, meta)
+    if response.status_code == 304:
+        return NOT_MODIFIED
+    if response.status_code != 200:
+        err = f"Failed to fetch the page for patch {patch_id}: {response.status_code}"
+        raise ValueError(err)
     soup = BeautifulSoup(response.text, "html.parser")
     
     # We will extract the patches recursively from these later on
     message_ids = _helper_get_patch_message_ids(soup)
     name = _helper_get_patch_name(soup)
+    latest_activity = _helper_get_thread_latest_activity(soup)
 
     return {
         "patch_id": patch_id,
         "message_ids": message_ids,
-        "patch_name": name
+        "patch_name": name,
+        "latest_activity": latest_activity
     }
 
+@cache_results(ttl=PAGE_TTL, revalidate=lambda meta, patch_id: _get_patch_info(patch_id, meta))
+def get_patch_info(patch_id):
+    return _get_patch_info(patch_id)
+
+# Uncached, for when the latest activity on each thread has to be current.
+def fetch_patch_info(patch_id):
+    return _get_patch_info(patch_id)
+
 def _helper_get_patch_message_ids(soup):
     pattern = re.compile(r'https://www.postgresql.org/message-id/flat/(.*)')
 
@@ -163,6 +163,28 @@ def _helper_get_patch_message_ids(soup):
 
     return list(set(ids))
 
+def _helper_get_thread_latest_activity(soup):
+    """
+    {message id: date of the thread's latest message}, from the "Latest at"
+    line the patch page shows under each thread. Threads without a readable
+    date are left out.
+    """
+    pattern = re.compile(r'https://www.postgresql.org/message-id/flat/(.*)')
+    date_pattern = re.compile(r'Latest at\s+(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(?::\d{2})?)')
+
+    latest = {}
+    for a_tag in soup.find_all('a', href=True):
+        match = pattern.match(a_tag['href'])
+        title = a_tag.find_parent('dt') if match else None
+        details = title.find_next_sibling('dd') if title else None
+        if details is None:
+            continue
+        date = date_pattern.search(details.get_text(' ', strip=True))
+        if date:
+            latest[match.group(1)] = date.group(1).replace('T', ' ')
+
+    return latest
+
 def _helper_get_patch_name(soup):
     title = soup.find('h1')
     
@@ -0,0 +1,282 @@
+from bs4 import BeautifulSoup
+from datetime import datetime, timezone
+import os
+import re
+
+# "html.parser" matches what the rest of the scraper has always used, so the text
+# we send to the LLM (and therefore its cache keys) stays the same. Set
+# HTML_PARSER=lxml for a faster parse if lxml is installed.
+HTML_PARSER = os.environ.get("HTML_PARSER", "html.parser")
+
+ATTACHMENT_BASE_URL = 'https://postgresql.org'
+
+# Bump whenever the output of parse_thread_html changes shape, so cached
+# parsed threads get rebuilt.
+PARSED_THREAD_VERSION = 1
+
+
+def parse_thread_html(html):
+    """
+    Parse a flat mailing list thread page once, and return everything the
+    pipeline needs from it:
+      - text: all text of the thread, one element per line
+      - attachment_links: hrefs in the last attachments table of the thread
+      - from_and_date: [(from_name, date_str), ...] for every message header
+      - messages: one dict per email, in thread order, with
+          header: {author, sent_utc}
+          body: the HTML of the message content
+          lines: [(is_quote, line_text), ...] of the message content
+          attachments: [{name, url, size, contentType}, ...], or None if the
+            email has no attachments table
+    """
+    soup = BeautifulSoup(html, HTML_PARSER)
+
+    wrap = soup.find("div", id="pgContentWrap")
+    if wrap is None:
+        raise ValueError("Could not find wrapper")
+
+    attachment_tables = soup.find_all("table", class_="message-attachments")
+    if attachment_tables:
+        # Select the last table, and all <a> tags (with href) in it
+        attachment_links = [anchor["href"] for anchor in attachment_tables[-1].find_all("a", href=True)]
+    else:
+        attachment_links = []
+
+    return {
+        "text": wrap.get_text(separator="\n", strip=True),  # Extracts all text recursively
+        "attachment_links": attachment_links,
+        "from_and_date": extract_from_and_date(soup),
+        "messages": parse_messages(wrap),
+    }
+
+
+def extract_from_and_date(soup):
+    """
+    Given a BeautifulSoup object of the entire HTML document,
+    find all message-header tables and extract the From name and Date
+    from each table. Returns a list of tuples: [(from_name, date_str), ...].
+    """
+
+    def parse_email_header(table):
+        """
+        Given a BeautifulSoup <table> containing an email header,
+        return a tuple (from_name, date_str).
+        """
+        from_th = table.find('th', string='From:')
+        from_td = from_th.find_next('td') if from_th else None
+        from_text = from_td.get_text(strip=True) if from_td else ""
+
+        # Extract the name from something like:
+        #   "\"Hayato Kuroda (Fujitsu)\" <kuroda(dot)hayato(at)fujitsu(dot)com>"
+        match = re.match(r'^"([^"]+)"', from_text)
+        if match:
+            from_name = match.group(1)
+        else:
+            # If no quotes found, split at '<'
+            from_name = from_text.split('<')[0].strip()
+
+        date_th = table.find('th', string='Date:')
+        date_td = date_th.find_next('td') if date_th else None
+        date_str = date_td.get_text(strip=True) if date_td else ""
+
+        return (from_name, date_str)
+
+    results = []
+
+    tables = soup.find_all('table', class_='table-sm table-responsive message-header')
+    for t in tables:
+        info = parse_email_header(t)
+        if len(info[0]):
+            results.append(info)
+    return results
+
+
+'''
+The mailing list lays out components of each email at the same level, like so:
+
+<table class="message-header" ></table>
+<div class="message-content" ></div>
+<table class="message-attachments" ></table>
+
+This method packages components of the same email together.
+'''
+
+def parse_messages(wrap):
+    top_elems = wrap.find_all(["table", "div"], recursive=False)
+
+    messages = []
+    current_message = {}
+
+    # The first header table is not part of a message
+    first_table_ignored = False
+
+    for element in top_elems:
+        # If we haven't ignored the first table yet and this is a table, skip it.
+        if element.name == "table" and not first_table_ignored:
+            first_table_ignored = True
+            continue
+
+        classes = element.get("class", [])
+
+        if "message-header" in classes:
+            # If there's an existing message in the pipeline, finalize it
+            if "header" in current_message:
+                messages.append(current_message)
+                current_message = {}
+            current_message["header"] = parse_header(element)
+
+        elif "message-content" in classes:
+            current_message["body"] = str(element)
+            current_message["lines"] = parse_email_lines(element)
+
+        elif "message-attachments" in classes:
+            current_message["attachments"] = parse_attachments(element)
+
+    # If we ended with a partial message, finalize it
+    if "header" in current_message:
+        messages.append(current_message)
+
+    return messages
+
+
+# Get author and date
+def parse_header(table):
+    """
+    Parse a message header table and return a dict with:
+      - author: the 'From' name (no email address)
+      - sent_utc: an ISO8601 UTC date string (e.g., '2014-10-10T07:57:56Z')
+    """
+    # Initialize results
+    author = None
+    sent_utc = None
+
+    # Each row is <tr> with a <th scope="row"> label and a <td> value
+    for row in table.find_all('tr'):
+        th = row.find('th', scope='row')
+        td = row.find('td')
+        if not th or not td:
+            continue
+
+        label = th.get_text(strip=True)
+        value = td.get_text(strip=True)
+
+        if label == "From:":
+            # 'Andres Freund <andres(at)2ndquadrant(dot)com>'
+            # We just want the name portion, so split on '<'
+            # or, if there's no bracket, just take the entire string.
+            bracket_index = value.find('<')
+            if bracket_index != -1:
+                author = value[:bracket_index].strip()
+            else:
+                author = value.strip()
+
+        elif label == "Date:":
+            # '2014-10-10 07:57:56'
+            # Assume this is already UTC
+            # Convert to an ISO8601 string with trailing Z
+            dt = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            dt_utc = dt.replace(tzinfo=timezone.utc)
+            sent_utc = dt_utc.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    return {
+        "author": author,
+        "sent_utc": sent_utc
+    }
+
+
+def parse_email_lines(content) -> list[tuple[bool, str]]:
+    """
+    Split the text of a message-content element into a list of
+    (is_quote, line_text) tuples.
+    """
+    # Use get_text with a separator so <br/> becomes newlines.
+    all_text = content.get_text("\n")
+
+    lines = []
+    for raw_line in all_text.splitlines():
+        line = raw_line.strip()
+        if not line:
+            continue  # Skip blank lines if desired.
+
+        # Check if line starts with one or more '>' characters.
+        match = re.match(r"^>+", line)
+        if match:
+            # It's a quote. Remove all leading '>' chars and surrounding spaces.
+            stripped_line = re.sub(r"^>+", "", line).strip()
+            lines.append((True, stripped_line))
+        else:
+            # Not a quote
+            lines.append((False, line))
+
+    return lines
+
+
+def parse_attachments(table):
+    """
+    Parse a message-attachments table, returning a list of attachments
+    with fields: name, url, size, contentType.
+    Converts the human-readable size to an integer (bytes).
+    """
+    attachments = []
+    tbody = table.find("tbody")
+    if not tbody:
+        return []
+
+    for row in tbody.find_all("tr"):
+        link_cell = row.find("th")
+        link_tag = link_cell.find("a") if link_cell else None
+        name = link_tag.text.strip() if link_tag else None
+        url  = link_tag["href"] if link_tag and link_tag.has_attr("href") else None
+
+        cells = row.find_all("td")
+        if len(cells) != 2:
+            continue
+
+        attachments.append({
+            "name": name,
+            "url": ATTACHMENT_BASE_URL + url if url else None,
+            "size": parse_size_to_bytes(cells[1].get_text(strip=True)),
+            "contentType": cells[0].get_text(strip=True)
+        })
+
+    return attachments
+
+
+def parse_size_to_bytes(size_str):
+    """
+    Parse a human-readable file size string (e.g., '11.0 KB', '2.9 MB')
+    into an integer number of bytes.
+    """
+    # Replace non-breaking spaces and strip whitespace.
+    size_str = size_str.replace('\xa0', ' ').strip()
+    if not size_str:
+        return 0
+
+    parts = size_str.split()
+    if len(parts) < 2:
+        # If there's no clear unit (just a number?), treat it as bytes
+        try:
+            return int(parts[0])
+        except ValueError:
+            return 0
+
+    try:
+        # Numeric part
+        value = float(parts[0])
+        # Unit part
+        unit = parts[1].lower()
+    except ValueError:
+        return 0
+
+    # Map from unit to multiplier
+    multipliers = {
+        'b': 1,
+        'bytes': 1,
+        'kb': 1024,
+        'mb': 1024 ** 2,
+        'gb': 1024 ** 3
+    }
+
+    # If the unit is not recognized, we'll assume bytes.
+    multiplier = multipliers.get(unit, 1)
+    return int(value * multiplier)
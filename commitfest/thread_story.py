@@ -1,16 +1,13 @@
 
 
-from scrape import fetch_thread
-from llm import prompt_gemini, clean_gemini_json
-from cache import cache_results
-from worker import run_jobs
+from scrape import get_parsed_thread, parsed_thread_version
+from llm import prompt_gemini, estimate_tokens
+from cache import cache_results, previous_result, has_legacy_entry
+from worker import run_jobs, run_in_process
 
-import requests
-from bs4 import BeautifulSoup
+from fetch import http_get
 
 from pprint import pprint
-from datetime import datetime, timezone
-import re
 import json
 
 PATCH_TOO_LARGE = 'patch_too_large_for_analysis'
@@ -28,12 +25,14 @@ PATCH_TOO_LARGE = 'patch_too_large_for_analysis'
 
 '''
 def describe_message(args):
-    (key, contents) = args
-    header = describe_header(contents['header'])
-    body = describe_body(key, contents['body'])
-
-    if 'attachments' in contents:
-        attachments = list_attachments(contents['attachments'])
+    (key, contents, body) = args
+    header = contents['header']
+    if body is None:
+        body = describe_body(key, contents['body'])
+
+    if contents.get('attachments') is not None:
+        # Only patches are worth describing
+        attachments = [dict(a) for a in contents['attachments'] if a['contentType'] == 'text/x-patch']
     else:
         attachments = None
 
@@ -52,64 +51,8 @@ def describe_message(args):
     }
 
 
-# Get author and date
-def describe_header(html_str):
-    """
-    Parse the message header HTML and return a dict with:
-      - author: the 'From' name (no email address)
-      - sent_utc: an ISO8601 UTC date string (e.g., '2014-10-10T07:57:56Z')
-    """
-    soup = BeautifulSoup(html_str, "html.parser")
-    
-    # Initialize results
-    author = None
-    sent_utc = None
-    
-    # Each row is <tr> with a <th scope="row"> label and a <td> value
-    for row in soup.find_all('tr'):
-        th = row.find('th', scope='row')
-        td = row.find('td')
-        if not th or not td:
-            continue
-        
-        label = th.get_text(strip=True)
-        value = td.get_text(strip=True)
-        
-        if label == "From:":
-            # 'Andres Freund <andres(at)2ndquadrant(dot)com>'
-            # We just want the name portion, so split on '<'
-            # or, if there's no bracket, just take the entire string.
-            # e.g., "Andres Freund <andres(at)2ndquadrant(dot)com>"
-            bracket_index = value.find('<')
-            if bracket_index != -1:
-                author = value[:bracket_index].strip()
-            else:
-                author = value.strip()
-                
-        elif label == "Date:":
-            # '2014-10-10 07:57:56'
-            # Assume this is already UTC
-            # Convert to an ISO8601 string with trailing Z
-            dt = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
-            dt_utc = dt.replace(tzinfo=timezone.utc)
-            sent_utc = dt_utc.strftime("%Y-%m-%dT%H:%M:%SZ")
-    
-    return {
-        "author": author,
-        "sent_utc": sent_utc
-    }
-
-
-# Describe message and determine what kind of response it is
-@cache_results(0)
-def describe_body(key, contents):
-
-    prompt = f'''
-        You are reading an email in a mailing list thread that discusses 
-        a potential feature for the Postgres database. 
-
-        You should output a JSON with the following 2 components:
-        1. A one-sentence summary of the email (we'll use this to overview the thread itself.)
+# What we ask the LLM to say about each email; shared by the single and batched prompts.
+BODY_GUIDE = '''        1. A one-sentence summary of the email (we'll use this to overview the thread itself.)
         2. The status of the email. This should be one of the following:
             * PATCH_SET --> The email itself contains some additional patches. 
             * REQUEST_CHANGES --> The email provides feedback on an earlier proposal, requesting some changes.
@@ -122,7 +65,21 @@ def describe_body(key, contents):
 
             Note that these statuses are in precedence order: If an email requests some changes AND includes
             a patch-set, we should call it a "PATCH_SET". If the email approves some changes and requests changes
-            in others, we should call it a "REQUEST_CHANGES", not "APPROVAL", and so on.
+            in others, we should call it a "REQUEST_CHANGES", not "APPROVAL", and so on.'''
+
+# Roughly how many prompt tokens of email bodies to pack into one batched request.
+BODY_BATCH_TOKENS = 30000
+BODY_BATCH_MAX_MESSAGES = 25
+
+# Describe message and determine what kind of response it is
+def describe_body(key, contents):
+
+    prompt = f'''
+        You are reading an email in a mailing list thread that discusses 
+        a potential feature for the Postgres database. 
+
+        You should output a JSON with the following 2 components:
+{BODY_GUIDE}
 
         Here is the body of the email: 
 
@@ -140,110 +97,106 @@ def describe_body(key, contents):
 
     '''
     
-    result = prompt_gemini(prompt)
+    # descriptions were cached on the message key before they were cached on the prompt
+    return prompt_gemini(prompt, as_json=True, legacy_key=f"describe_body_{key}")
 
-    return clean_gemini_json(result)
 
-def parse_size_to_bytes(size_str):
+def batch_bodies(keys_and_bodies):
+    """
+    Split [(key, body), ...] into batches of at most BODY_BATCH_MAX_MESSAGES
+    messages and roughly BODY_BATCH_TOKENS tokens. A body that is too big on
+    its own gets a batch to itself.
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    for key, body in keys_and_bodies:
+        tokens = estimate_tokens(body)
+        if current and (current_tokens + tokens > BODY_BATCH_TOKENS or len(current) >= BODY_BATCH_MAX_MESSAGES):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((key, body))
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def describe_body_batch(batch):
     """
-    Parse a human-readable file size string (e.g., '11.0 KB', '2.9 MB')
-    into an integer number of bytes.
+    Describe several emails with one prompt. Returns [(key, description), ...].
+    If the answer doesn't parse into one description per email, falls back to
+    describe_body for each of them.
     """
-    # Replace non-breaking spaces and strip whitespace.
-    size_str = size_str.replace('\xa0', ' ').strip()
-    if not size_str:
-        return 0
-
-    parts = size_str.split()
-    if len(parts) < 2:
-        # If there's no clear unit (just a number?), treat it as bytes
-        try:
-            return int(parts[0])
-        except ValueError:
-            return 0
+    if len(batch) == 1:
+        key, body = batch[0]
+        return [(key, describe_body(key, body))]
 
-    try:
-        # Numeric part
-        value = float(parts[0])
-        # Unit part
-        unit = parts[1].lower()
-    except ValueError:
-        return 0
-
-    # Map from unit to multiplier
-    multipliers = {
-        'b': 1,
-        'bytes': 1,
-        'kb': 1024,
-        'mb': 1024 ** 2,
-        'gb': 1024 ** 3
-    }
+    emails = '\n\n'.join([f'=== EMAIL {i} ===\n{body}' for i, (_key, body) in enumerate(batch)])
 
-    # If the unit is not recognized, we'll assume bytes.
-    multiplier = multipliers.get(unit, 1)
-    return int(value * multiplier)
+    prompt = f'''
+        You are reading {len(batch)} emails from a mailing list thread that discusses 
+        a potential feature for the Postgres database. Each email starts with a line
+        like "=== EMAIL 0 ===".
 
+        For EACH email, you should output a JSON with the following 2 components:
+{BODY_GUIDE}
 
-def list_attachments(html_snippet):
-    """
-    Parse the HTML snippet for the attachments table,
-    returning a list of attachments with fields:
-    name, url, size, contentType.
+        Here are the bodies of the emails: 
 
-    Only returns attachments with content-type text/x-patch.
-    Converts the human-readable size to an integer (bytes).
-    """
-    base_url = 'https://postgresql.org'
-    soup = BeautifulSoup(html_snippet, "html.parser")
-    attachments_table = soup.find("table", class_="message-attachments")
-    if not attachments_table:
-        return []
-    
-    attachments = []
-    tbody = attachments_table.find("tbody")
-    if not tbody:
-        return []
+        { 
+            emails
+        }
 
-    rows = tbody.find_all("tr")
-    
-    for row in rows:
-        link_cell = row.find("th")
-        link_tag = link_cell.find("a") if link_cell else None
-        name = link_tag.text.strip() if link_tag else None
-        url  = link_tag["href"] if link_tag and link_tag.has_attr("href") else None
-        
-        cells = row.find_all("td")
-        if len(cells) != 2:
-            continue
-        
-        content_type = cells[0].get_text(strip=True)
-        size_str = cells[1].get_text(strip=True)
-        
-        # Filter only text/x-patch
-        if content_type != "text/x-patch":
-            continue
-        
-        # Convert size to bytes
-        size_bytes = parse_size_to_bytes(size_str)
-        
-        attachments.append({
-            "name": name,
-            "url": base_url + url,
-            "size": size_bytes,
-            "contentType": content_type
-        })
-    
-    return attachments
+        Please output your verdicts as a JSON array with exactly one entry per email, in the same order
+        as the emails, and no other commentary so we can parse it cleanly. Your first character should be a 
+        [ and your last, a ]. The format should be:
 
+        [
+            {{
+                "email": <number of the email, starting from 0>,
+                "summary": "one-line summary of email",
+                "status": "PATCH_SET|REQUEST_CHANGES|APPROVAL|OTHER"
+            }},
+            ...
+        ]
+
+    '''
+
+    try:
+        descriptions = prompt_gemini(prompt, as_json=True)
+        if not isinstance(descriptions, list) or len(descriptions) != len(batch):
+            raise ValueError(f"Expected {len(batch)} descriptions")
+        by_position = {int(d["email"]): {"summary": d["summary"], "status": d["status"]} for d in descriptions}
+        return [(key, by_position[i]) for i, (key, _body) in enumerate(batch)]
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Batched description of {len(batch)} emails failed ({e}); describing them one at a time")
+        return [(key, describe_body(key, body)) for key, body in batch]
+
+
+def describe_bodies(keys_and_bodies):
+    """Describe many emails in as few LLM requests as possible. Returns {key: description}."""
+    # messages described one by one by earlier versions are left to describe_body,
+    # which finds those descriptions instead of asking again
+    keys_and_bodies = [(key, body) for key, body in keys_and_bodies if not has_legacy_entry(f"describe_body_{key}")]
+    batches = batch_bodies(keys_and_bodies)
+    results = run_jobs(describe_body_batch, batches, 10, payload_arg_key_fn=lambda batch: batch[0][0])
+    descriptions = {}
+    for described in results.values():
+        if 'error' in described:
+            continue # those messages get described individually by describe_message
+        descriptions.update(dict(described))
+    return descriptions
 
 def describe_attachment(args):
     key, properties = args
 
     # 1. fetch the attachment
-    contents = requests.get(properties["url"]).text
+    contents = http_get(properties["url"]).text
 
     ret = {
-        "stats": parse_diff_stats(contents),
+        "stats": run_in_process(parse_diff_stats, contents),
     }
 
     if len(contents) < 50000:
@@ -284,67 +237,12 @@ def describe_attachment(args):
 
         '''
         
-        result = prompt_gemini(prompt)
-
-        cleaned_result = clean_gemini_json(result)
-
-        ret["analysis"] = cleaned_result
+        ret["analysis"] = prompt_gemini(prompt, as_json=True)
 
     return ret
 
 
 
-'''
-The mailing list lays out components of each email at the same level, like so:
-
-<table class="message-header" ></table>
-<div class="message-content" ></div>
-<table class="message-attachments" ></table>
-
-This method packages components of the same email together.
-'''
-
-def parse_messages(soup):
-    wrap = soup.find(id="pgContentWrap")
-    if wrap is None:
-        raise ValueError("Could not find wrapper")
-
-    top_elems = wrap.find_all(["table", "div"], recursive=False)
-    
-    messages = []
-    current_message = {}
-    
-    # The first header table is not part of a message
-    first_table_ignored = False
-
-    for element in top_elems:
-        # If we haven't ignored the first table yet and this is a table, skip it.
-        if element.name == "table" and not first_table_ignored:
-            first_table_ignored = True
-            continue
-        
-        classes = element.get("class", [])
-        
-        if "message-header" in classes:
-            # If there's an existing message in the pipeline, finalize it
-            if "header" in current_message:
-                messages.append(current_message)
-                current_message = {}
-            current_message["header"] = str(element)
-        
-        elif "message-content" in classes:
-            current_message["body"] = str(element)
-        
-        elif "message-attachments" in classes:
-            current_message["attachments"] = str(element)
-    
-    # If we ended with a partial message, finalize it
-    if "header" in current_message:
-        messages.append(current_message)
-    
-    return messages
-
-
 def parse_diff_stats(diff_text: str):
     """
     Parse a git diff/patch file and return:
@@ -379,9 +277,8 @@ def trace_thread_references(thread):
     line_source = {}
 
     for message in thread:
-        text = message['contents']['body']
         message['references'] = []
-        lines = parse_email_snippet(text)
+        lines = message['contents']['lines']
 
         for is_quoted, line in lines:
             if len(line) < 20:
@@ -394,45 +291,31 @@ def trace_thread_references(thread):
         message['references'] = list(set(message['references']))
 
 
-def parse_email_snippet(html_snippet: str) -> list[tuple[bool, str]]:
-    """
-    Parse an HTML snippet from an email, returning a list of (is_quote, line_text) tuples.
-
-    :param html_snippet: The HTML email snippet to parse
-    :return: A list of (is_quote, line_text) tuples
-    """
-    soup = BeautifulSoup(html_snippet, "html.parser")
-    # Use get_text with a separator so <br/> becomes newlines.
-    all_text = soup.get_text("\n")
-
-    lines = []
-    for raw_line in all_text.splitlines():
-        line = raw_line.strip()
-        if not line:
-            continue  # Skip blank lines if desired.
-
-        # Check if line starts with one or more '>' characters.
-        match = re.match(r"^>+", line)
-        if match:
-            # It's a quote. Remove all leading '>' chars and surrounding spaces.
-            stripped_line = re.sub(r"^>+", "", line).strip()
-            lines.append((True, stripped_line))
-        else:
-            # Not a quote
-            lines.append((False, line))
-
-    return lines
-
-@cache_results()
+# The story is redone (incrementally) whenever the parsed thread changes, and
+# only then, so it can never be older than the thread it was told from.
+@cache_results(version=parsed_thread_version)
 def tell_thread_story(thread_id):
-    # 1. Load thread text
-    text = fetch_thread(thread_id)
-    soup = BeautifulSoup(text, "html.parser")
-
-    message_components = parse_messages(soup)
-    messages_with_ids = [ ((thread_id, index), components) for index, components in enumerate(message_components)  ]
+    # 1. Load parsed thread
+    message_components = get_parsed_thread(thread_id)["messages"]
+
+    # 2. When retelling the story of a changed thread, keep the descriptions of messages we've
+    # already seen. The flat thread page only ever appends, so a message at the
+    # same position with the same author and date is the same message.
+    known = {}
+    for message in previous_result() or []:
+        index = message["key"][1]
+        if index < len(message_components) and message_components[index]["header"] == message["header"]:
+            known[index] = dict(message, key=(thread_id, index), contents=message_components[index])
+    new_messages = [ (index, components) for index, components in enumerate(message_components) if index not in known ]
+    if known:
+        print(f"Thread {thread_id}: {len(new_messages)} new messages since last run")
+
+    # 3. Describe only the new messages
+    bodies = describe_bodies([ ((thread_id, index), components['body']) for index, components in new_messages if 'body' in components ])
+    messages_with_ids = [ ((thread_id, index), components, bodies.get((thread_id, index))) for index, components in new_messages ]
 
     messages = run_jobs(describe_message, messages_with_ids, 10, payload_arg_key_fn= lambda x: (x[0]))
+    messages.update({ (thread_id, index): message for index, message in known.items() })
 
     thread = [message for (_, message) in sorted(messages.items(), key= lambda x: x[0][1])]
 
@@ -443,7 +326,6 @@ def tell_thread_story(thread_id):
 
     return results
 
-@cache_results(0, 0)
 def rank_for_beginners(args):
 
     thread, story = args
@@ -505,9 +387,7 @@ the ideal patch for a new person is one that's not a deeply bad idea in some way
 
     '''
 
-    result = prompt_gemini(prompt)
-
-    return clean_gemini_json(result)
+    return prompt_gemini(prompt, as_json=True, legacy_key=f"rank_for_beginners_{thread}")
 
 
 def main():
@@ -1,26 +1,227 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from itertools import islice
+from queue import Queue, Empty
+from time import monotonic
+import multiprocessing
+import os
+import threading
 
+# Print progress at most this often, in seconds, rather than once per job.
+PROGRESS_INTERVAL = 5
 
-def run_jobs(fn, payloads, max_workers=5, payload_arg_key_fn=None):
-    results = {}
-    errors = 0
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        job_to_args = {executor.submit(fn, args): args for args in payloads}
-
-        for job in as_completed(job_to_args):
-            args = job_to_args[job]
-            if payload_arg_key_fn:
-                key = payload_arg_key_fn(args)
-            else:
-                key = args
+# Every run_jobs call in the process shares one pool of this many threads, however
+# deeply the calls nest.
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 64))
+
+# Process-wide budgets for how many jobs may use each kind of resource at once.
+# Code that uses one wraps that part in `with resource(name):`.
+RESOURCE_LIMITS = {
+    "http": int(os.environ.get("HTTP_CONCURRENCY", 16)),  # requests to postgresql.org
+    "llm": int(os.environ.get("GEMINI_MAX_CONCURRENCY", 32)),  # Gemini requests; llm.LIMITER adapts below this
+    "cpu": int(os.environ.get("CPU_CONCURRENCY", os.cpu_count() or 4)),  # HTML parsing, SVG drawing
+}
+
+_resource_slots = {name: threading.BoundedSemaphore(limit) for name, limit in RESOURCE_LIMITS.items()}
+
+@contextmanager
+def resource(name):
+    """Hold one of the process-wide slots for a resource class while the block runs."""
+    with _resource_slots[name]:
+        yield
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _shared_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="run_jobs")
+        return _executor
+
+
+# CPU-bound pure-Python work (HTML parsing, diff stats, SVG drawing) is
+# serialized by the GIL on threads, so it goes to a pool of this many worker
+# processes instead. Set CPU_PROCESSES=0 to run it inline on the calling thread.
+CPU_PROCESSES = int(os.environ.get("CPU_PROCESSES", RESOURCE_LIMITS["cpu"]))
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _shared_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn rather than fork: forking a process that has threads running
+            # can leave locks in the child held forever
+            _process_pool = ProcessPoolExecutor(max_workers=CPU_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+
+def run_in_process(fn, *args):
+    """
+    Call fn(*args) in the CPU process pool and wait for the result. fn must be
+    a module-level function, and args and the result must be picklable. For
+    CPU-bound steps inside jobs that otherwise wait on I/O.
+    """
+    with resource("cpu"):
+        if CPU_PROCESSES == 0:
+            return fn(*args)
+        return _shared_process_pool().submit(fn, *args).result()
+
+
+def _run_chunk(fn, chunk):
+    """Runs in a worker process: fn over each payload of a chunk, catching errors per payload."""
+    results = []
+    for args in chunk:
+        try:
+            results.append((args, fn(args), None))
+        except Exception as e:
+            results.append((args, None, e))
+    return results
+
+
+class _Job:
+    """
+    One call of fn(args). It is queued on the shared pool, but whichever
+    thread claims it first runs it: a pool thread, or the thread waiting on
+    its results (see stream_jobs).
+    """
+
+    def __init__(self, fn, args, completed):
+        self.fn = fn
+        self.args = args
+        self.completed = completed
+        self.claimed = False
+        self.lock = threading.Lock()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        with self.lock:
+            if self.claimed:
+                return
+            self.claimed = True
+        try:
+            self.result = self.fn(self.args)
+        except Exception as e:
+            self.error = e
+        self.completed.put(self)
+
+
+def _thread_lane(fn, payloads, max_workers):
+    """Yields (args, result, error) as jobs finish on the shared thread pool."""
+    executor = _shared_executor()
+    completed = Queue()
+    in_flight = []
+
+    def fill():
+        for args in islice(payloads, max_workers - len(in_flight)):
+            job = _Job(fn, args, completed)
+            in_flight.append(job)
+            executor.submit(job.run)
+
+    fill()
+    while in_flight:
+        try:
+            job = completed.get_nowait()
+        except Empty:
+            unclaimed = next((job for job in in_flight if not job.claimed), None)
+            if unclaimed is not None:
+                unclaimed.run()
+                continue
+            job = completed.get()
+
+        in_flight.remove(job)
+        yield job.args, job.result, job.error
+        fill()
+
+
+def _process_lane(fn, payloads, max_workers, chunksize):
+    """
+    Yields (args, result, error) as chunks of jobs finish in the CPU process
+    pool. Each chunk is pickled over to a worker process whole, so payloads
+    share nothing with the parent, and small jobs don't each pay a round trip.
+    """
+    if CPU_PROCESSES == 0:
+        for args in payloads:
+            yield _run_chunk(fn, [args])[0]
+        return
+
+    pool = _shared_process_pool()
+    in_flight = {}  # future -> chunk
+
+    def fill():
+        while len(in_flight) < max_workers:
+            chunk = list(islice(payloads, chunksize))
+            if not chunk:
+                return
+            in_flight[pool.submit(_run_chunk, fn, chunk)] = chunk
+
+    fill()
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            chunk = in_flight.pop(future)
             try:
-                results[key] = job.result()
+                yield from future.result()
             except Exception as e:
-                print(e)
-                results[key] = {"error": str(e)}
-                errors += 1
+                # the chunk couldn't be sent or the worker died; fail each of its jobs
+                for args in chunk:
+                    yield args, None, e
+        fill()
 
-            print(f"Progress: {len(results)}/{len(payloads)} | Errors: {errors}")
 
-    return results
+def stream_jobs(fn, payloads, max_workers=5, payload_arg_key_fn=None, lane="thread", chunksize=8):
+    """
+    Run fn over payloads, yielding (key, result) pairs as jobs finish. At most
+    max_workers of these jobs are in flight at once, and payloads can be a
+    generator: nothing is held in memory beyond what the caller keeps. A job
+    that raises yields {"error": <message>}.
+
+    Jobs run on the process-wide pool shared by all run_jobs calls. Calls may
+    nest (a job can call run_jobs itself): while waiting, the calling thread
+    runs any of its own jobs that no pool thread has picked up yet, so nested
+    calls always make progress even when every pool thread is busy waiting.
+
+    With lane="process", jobs instead go to the CPU process pool, chunksize
+    payloads at a time, with up to max_workers chunks in flight. Use it for
+    CPU-bound jobs; fn must be a module-level function, and payloads and
+    results picklable.
+    """
+    total = len(payloads) if hasattr(payloads, "__len__") else "?"
+    payloads = iter(payloads)
+    if lane == "process":
+        finished = _process_lane(fn, payloads, max_workers, chunksize)
+    else:
+        finished = _thread_lane(fn, payloads, max_workers)
+
+    done_count = 0
+    errors = 0
+    last_report = monotonic()
+
+    for args, result, error in finished:
+        if payload_arg_key_fn:
+            key = payload_arg_key_fn(args)
+        else:
+            key = args
+        if error is not None:
+            print(error)
+            result = {"error": str(error)}
+            errors += 1
+
+        done_count += 1
+        if monotonic() - last_report >= PROGRESS_INTERVAL or done_count == total:
+            print(f"Progress: {done_count}/{total} | Errors: {errors}")
+            last_report = monotonic()
+
+        yield key, result
+
+    if done_count != total:
+        print(f"Progress: {done_count}/{done_count} | Errors: {errors}")
+
 
+def run_jobs(fn, payloads, max_workers=5, payload_arg_key_fn=None, lane="thread", chunksize=8):
+    return dict(stream_jobs(fn, payloads, max_workers, payload_arg_key_fn, lane, chunksize))
@@ -1,20 +1,22 @@
 import os
 import re
-import json
-from git import Repo
+import sys
+import time
+import shutil
+from array import array
+from statistics import median
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from git import Repo
+from git.exc import GitCommandError
 
-# Global variable to store the repo handle per worker
-global_repo = None
+from history_store import HistoryWriter, read_manifest
+from git_log import iter_log_commits
 
-def init_worker(repo_path):
-    """
-    Initialize each worker by opening the repository only once.
-    """
-    global global_repo
-    global_repo = Repo(os.path.expanduser(repo_path))
+# Commits per task sent to the process pool. Each task runs one git log over
+# its range, so this trades IPC and git startup against load balancing.
+COMMITS_PER_TASK = int(os.environ.get("COMMITS_PER_TASK", 2000))
 
-def extract_commit_associations(commit):
+def extract_commit_associations(message):
     """
     Extract associated people from the commit message.
     Looks for lines starting with one of these keys (case-insensitive):
@@ -30,32 +32,26 @@ def extract_commit_associations(commit):
         r'^(%s):\s+(.*?)(\s+<([^>]+)>)?\s*$' % '|'.join(assoc_keys),
         re.IGNORECASE | re.MULTILINE
     )
-    for match in pattern.finditer(commit.message):
+    for match in pattern.finditer(message):
         assoc_type = match.group(1).strip()
         name = match.group(2).strip()
         email = match.group(4).strip() if match.group(4) else 'no_email@none.com'
         associations.append((name, email, assoc_type))
     return associations
 
-def process_commit(commit_hexsha):
+def commit_records(commit):
     """
-    Process a single commit using the global repository handle.
-    Extract associations, stats, and return a list of records.
+    Turn one commit from git_log.iter_log_commits into history records:
+    one per file changed, per person associated with the commit.
     """
-    commit = global_repo.commit(commit_hexsha)
-
     # Extract associations from the commit message.
-    associations = extract_commit_associations(commit)
+    associations = extract_commit_associations(commit["message"])
     # Always include commit.author entry.
-    associations.append((commit.author.name, commit.author.email, "Commit Author"))
-    
-    stats = commit.stats.files
-    commit_date_iso = commit.committed_datetime.isoformat()
+    associations.append((commit["author_name"], commit["author_email"], "Commit Author"))
+
     records = []
 
-    for filepath, file_stats in stats.items():
-        additions = file_stats.get('insertions', 0)
-        deletions = file_stats.get('deletions', 0)
+    for filepath, additions, deletions in commit["files"]:
         for name, email, assoc_type in associations:
             person_str = f"{name} <{email}>"
             records.append([
@@ -63,40 +59,152 @@ def process_commit(commit_hexsha):
                 filepath,
                 additions,
                 deletions,
-                commit.hexsha,
-                commit_date_iso,
+                commit["hexsha"],
+                commit["date"],
                 assoc_type
             ])
     return records
 
-def collect_repo_history(repo_path, output_path, max_workers=4):
+def process_commit_chunk(args):
+    """
+    Process a contiguous range of commits in a worker process. The records
+    come back as compact columns rather than a list of lists: strings
+    dictionary-encoded, numbers in arrays, so little has to be pickled back.
+    """
+    repo_path, hexshas = args
+    started = time.perf_counter()
+
+    dictionaries = {"person": {}, "file": {}, "commit": {}, "assoc_type": {}}
+    columns = {name: array('I') for name in ["person", "file", "additions", "deletions", "commit", "assoc_type"]}
+    dates = []
+    failed = []
+
+    def encode(name, value):
+        dictionary = dictionaries[name]
+        if value not in dictionary:
+            dictionary[value] = len(dictionary)
+        return dictionary[value]
+
+    for commit in iter_log_commits(repo_path, hexshas):
+        try:
+            records = commit_records(commit)
+        except Exception as e:
+            print(f"Error processing commit {commit['hexsha']}: {e}")
+            failed.append(commit['hexsha'])
+            continue
+        commit_id = encode("commit", commit["hexsha"])
+        if commit_id == len(dates):
+            dates.append(commit["date"])
+        for person, filepath, additions, deletions, _hexsha, _date, assoc_type in records:
+            columns["person"].append(encode("person", person))
+            columns["file"].append(encode("file", filepath))
+            columns["additions"].append(additions)
+            columns["deletions"].append(deletions)
+            columns["commit"].append(commit_id)
+            columns["assoc_type"].append(encode("assoc_type", assoc_type))
+
+    return {
+        "values": {name: list(dictionary) for name, dictionary in dictionaries.items()},
+        "dates": dates,  # by commit id
+        "columns": columns,
+        "failed": failed,
+        "commits": len(hexshas),
+        "seconds": time.perf_counter() - started,
+    }
+
+def chunk_records(chunk):
+    """Decode the result of process_commit_chunk back into history records."""
+    values = chunk["values"]
+    columns = chunk["columns"]
+    for i in range(len(columns["person"])):
+        commit_id = columns["commit"][i]
+        yield [
+            values["person"][columns["person"][i]],
+            values["file"][columns["file"][i]],
+            columns["additions"][i],
+            columns["deletions"][i],
+            values["commit"][commit_id],
+            chunk["dates"][commit_id],
+            values["assoc_type"][columns["assoc_type"][i]],
+        ]
+
+def commits_to_process(repo, output_path, branch='master', full=False):
+    """
+    The hexshas to ingest, and the tip they bring the store up to. Only the
+    commits since the tip recorded by the last run (plus any that failed then),
+    unless the store is new, full is set, or the old tip is no longer an
+    ancestor of the branch (it was rebased or force-pushed): then the store is
+    cleared and the whole history rescanned.
+    """
+    tip = repo.commit(branch).hexsha
+    manifest = read_manifest(output_path)
+    last = manifest.get("tip")
+
+    if last and not full:
+        try:
+            still_ancestor = repo.is_ancestor(last, tip)
+        except GitCommandError:
+            still_ancestor = False  # the old tip isn't even in the repo anymore
+        if still_ancestor:
+            new_commits = [commit.hexsha for commit in repo.iter_commits(f'{last}..{tip}')]
+            print(f"Ingesting {len(new_commits)} new commits since {last[:12]}")
+            return new_commits + manifest.get("failed", []), tip
+        print(f"Last ingested commit {last[:12]} is no longer on {branch}, rescanning everything")
+
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    return [commit.hexsha for commit in repo.iter_commits(tip)], tip
+
+def collect_repo_history(repo_path, output_path, max_workers=None, full=False):
     """
-    Collect repository history in parallel using a process pool.
-    Uses an initializer to avoid re-opening the repository on every commit.
+    Collect repository history in parallel using a process pool, one
+    contiguous range of COMMITS_PER_TASK commits per task. Each task reads its
+    range with one streaming `git log --numstat` (see git_log.py), rather than
+    a git subprocess per commit. Records are streamed into a columnar history
+    store at output_path (see history_store.py) as tasks finish, so memory
+    use stays flat. max_workers defaults to the number of CPUs.
+
+    Incremental: the store remembers the last commit it ingested, and later
+    runs only process what's new since (see commits_to_process).
     """
     # Open the repository once in the main process to get commit hexshas
     repo = Repo(os.path.expanduser(repo_path))
-    commit_hexshas = [commit.hexsha for commit in repo.iter_commits('master')]
-    history_data = []
-
-    with ProcessPoolExecutor(max_workers=max_workers,
-                             initializer=init_worker,
-                             initargs=(repo_path,)) as executor:
-        futures = {executor.submit(process_commit, hexsha): hexsha for hexsha in commit_hexshas}
-        for i, future in enumerate(as_completed(futures), 1):
+    commit_hexshas, tip = commits_to_process(repo, output_path, full=full)
+    failed = []
+
+    chunks = [commit_hexshas[i:i + COMMITS_PER_TASK] for i in range(0, len(commit_hexshas), COMMITS_PER_TASK)]
+    chunk_seconds = []
+    processed = 0
+    started = time.perf_counter()
+
+    with HistoryWriter(output_path) as writer, \
+         ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = {executor.submit(process_commit_chunk, (repo_path, chunk)): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            # drop our reference so the finished future's records can be freed
+            chunk = futures.pop(future)
             try:
                 result = future.result()
-                history_data.extend(result)
             except Exception as e:
-                print(f"Error processing commit {futures[future]}: {e}")
-            if i % 1000 == 0:
-                print(f"Processed {i}/{len(commit_hexshas)} commits")
-    
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(history_data, f, indent=2)
-    print(f"Done! Wrote {len(history_data)} records to {output_path}")
+                print(f"Error processing commits {chunk[0]}..{chunk[-1]}: {e}")
+                failed.extend(chunk)
+                continue
+            writer.append(chunk_records(result))
+            failed.extend(result["failed"])
+            chunk_seconds.append(result["seconds"])
+            processed += result["commits"]
+            print(f"Processed {processed}/{len(commit_hexshas)} commits "
+                  f"(last chunk: {result['commits']} commits in {result['seconds']:.1f}s)")
+
+        # failed commits are retried by the next run
+        writer.commit(tip=tip, failed=failed)
+
+    if chunk_seconds:
+        print(f"Chunk times: min {min(chunk_seconds):.1f}s, median {median(chunk_seconds):.1f}s, "
+              f"max {max(chunk_seconds):.1f}s, {len(chunk_seconds)} chunks in {time.perf_counter() - started:.1f}s")
+    print(f"Done! Wrote {writer.manifest['rows']} records to {output_path}")
 
 if __name__ == "__main__":
     repo_path = "~/postgres/postgres"  # Path to your repository
-    output_path = "repo_history.json"  # Output JSON file
-    collect_repo_history(repo_path, output_path)
+    output_path = "repo_history"  # Output directory of history chunks
+    collect_repo_history(repo_path, output_path, full="--full" in sys.argv[1:])
@@ -0,0 +1,338 @@
+import os
+import sys
+import json
+import math
+import zlib
+import shutil
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime
+
+from history_store import iter_history_rows, read_manifest, committed_chunk_count
+
+# Activity loses half its weight every this many days.
+HALF_LIFE_DAYS = float(os.environ.get("EXPERTISE_HALF_LIFE_DAYS", 730))
+
+INDEX_VERSION = 5
+
+# Saved indexes split their file and directory vectors into this many shards,
+# so a lookup only reads the few that hold the paths it asks about.
+INDEX_SHARDS = int(os.environ.get("EXPERTISE_INDEX_SHARDS", 64))
+
+
+def _days(date):
+    return datetime.fromisoformat(date).timestamp() / 86400
+
+
+def ancestors(path):
+    """The directories above a path, nearest first: "src/a/b.c" -> ["src/a/", "src/", ""]."""
+    parts = path.split("/")[:-1]
+    return ["/".join(parts[:i]) + "/" for i in range(len(parts), 0, -1)] + [""]
+
+
+def rollup_directories(files):
+    """
+    {directory: {author number: weight}} summed over every file below each
+    directory, and {directory: number of files below it}.
+    """
+    directories = defaultdict(lambda: defaultdict(float))
+    sizes = defaultdict(int)
+    for path, weights in files.items():
+        for directory in ancestors(path):
+            sizes[directory] += 1
+            totals = directories[directory]
+            for number, weight in weights.items():
+                totals[number] += weight
+    return {directory: dict(totals) for directory, totals in directories.items()}, dict(sizes)
+
+
+def _shard_of(key, shards):
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+def _read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _read_meta(path):
+    meta_path = os.path.join(path, "meta.json")
+    meta = _read_json(meta_path) if os.path.isfile(meta_path) else {}
+    if meta.get("version") != INDEX_VERSION:
+        raise ValueError(f"{path} was built by a different version of expertise_index.py; rebuild it")
+    return meta
+
+
+def _vectors(saved):
+    # JSON object keys are strings, so vectors are saved as [[author number, weight], ...]
+    return {key: dict((number, weight) for number, weight in vector) for key, vector in saved.items()}
+
+
+def activity_weight(additions, deletions):
+    """How much one history row counts for, before decay: same as tf in tf-idf.sql."""
+    return math.log(1 + additions + deletions)
+
+
+class ExpertiseIndex:
+    """
+    Who knows which files, compiled from the repo history store.
+
+    files maps each path to a sparse vector {author number: weight}, and
+    author_files maps each author number back to the paths they've touched, so
+    matching a patch to experts costs one dict lookup per file it touches.
+    Author numbers are positions in authors, the "name <email>" strings of
+    the history store, and are only meaningful inside the index: they're not
+    the person ids of commitfest/identities.py, and one person with two emails
+    is two authors.
+
+    directories rolls the same vectors up to every directory level ("" is the
+    whole repo), so a file with no history of its own (a new test, a new
+    module) gets the experts of its nearest ancestor directory, averaged per
+    file so it doesn't outweigh the files that do have history, after at most
+    one lookup per level of its path.
+
+    Weights are decayed: each row counts activity_weight(...) halved every
+    half_life_days, as of the anchor date (the newest commit in the history).
+    They're running sums, so new history is added with add_rows without
+    revisiting the old: the sums are first rebased to the new anchor, which
+    decays them all by the same factor.
+    """
+
+    def __init__(self, authors, files, anchor, half_life_days=HALF_LIFE_DAYS, author_files=None, directories=None, directory_sizes=None, history=None):
+        self.authors = authors  # author number -> "name <email>"
+        self.author_numbers = {person: number for number, person in enumerate(authors)}
+        self.files = files  # path -> {author number: weight}
+        self.anchor = anchor  # in days since the epoch, None while empty
+        self.half_life_days = half_life_days
+
+        if author_files is None:
+            author_files = defaultdict(set)
+            for path, weights in files.items():
+                for number in weights:
+                    author_files[number].add(path)
+        self.author_files = author_files  # author number -> set of paths
+        if directories is None:
+            directories, directory_sizes = rollup_directories(files)
+        self.directories = directories  # directory -> {author number: weight}
+        self.directory_sizes = directory_sizes  # directory -> number of files
+        self.sorted_paths = sorted(files)
+        # which part of which history store this index has seen, for update_expertise_index
+        self.history = history or {"store_id": None, "chunks": 0}
+
+    def rebase(self, anchor):
+        """Move the anchor forward to anchor (days since the epoch), decaying every weight to match."""
+        if self.anchor is not None and anchor > self.anchor:
+            factor = 0.5 ** ((anchor - self.anchor) / self.half_life_days)
+            for vectors in (self.files, self.directories):
+                for weights in vectors.values():
+                    for number in weights:
+                        weights[number] *= factor
+        if self.anchor is None or anchor > self.anchor:
+            self.anchor = anchor
+
+    def add_rows(self, rows):
+        """
+        Add history rows to the running sums. rows is a function returning an
+        iterator over them, since they're read twice: once to find the new
+        anchor, once to add them up.
+        """
+        newest = max((_days(row[5]) for row in rows()), default=None)
+        if newest is None:
+            return
+        self.rebase(newest)
+
+        for person, path, additions, deletions, _commit, date, _assoc_type in rows():
+            if person not in self.author_numbers:
+                self.author_numbers[person] = len(self.authors)
+                self.authors.append(person)
+            number = self.author_numbers[person]
+            weight = activity_weight(additions, deletions) * 0.5 ** ((self.anchor - _days(date)) / self.half_life_days)
+
+            if path not in self.files:
+                self.files[path] = {}
+                for directory in ancestors(path):
+                    self.directory_sizes[directory] = self.directory_sizes.get(directory, 0) + 1
+            self.files[path][number] = self.files[path].get(number, 0) + weight
+            for directory in ancestors(path):
+                totals = self.directories.setdefault(directory, {})
+                totals[number] = totals.get(number, 0) + weight
+            self.author_files.setdefault(number, set()).add(path)
+
+        self.sorted_paths = sorted(self.files)
+
+    def decay(self, as_of=None):
+        """Factor that takes weights from the anchor date to as_of (an ISO date)."""
+        if as_of is None:
+            return 1.0
+        return 0.5 ** ((_days(as_of) - self.anchor) / self.half_life_days)
+
+    def _named(self, weights, as_of):
+        factor = self.decay(as_of)
+        return {self.authors[number]: weight * factor for number, weight in weights.items()}
+
+    def experts_for_file(self, path, as_of=None, fallback=True):
+        """
+        {person: score} for one file. A file with no history gets the experts of
+        its nearest ancestor directory that has some, unless fallback is False.
+        """
+        if path in self.files or not fallback:
+            return self._named(self.files.get(path, {}), as_of)
+        for directory in ancestors(path):
+            if directory in self.directories:
+                size = self.directory_sizes[directory]
+                return {person: score / size for person, score in self._named(self.directories[directory], as_of).items()}
+        return {}
+
+    def experts_for_prefix(self, prefix, as_of=None):
+        """{person: score} summed over every file whose path starts with prefix, e.g. "src/backend/"."""
+        if prefix in self.directories:
+            return self._named(self.directories[prefix], as_of)
+
+        totals = defaultdict(float)
+        for i in range(bisect_left(self.sorted_paths, prefix), len(self.sorted_paths)):
+            path = self.sorted_paths[i]
+            if not path.startswith(prefix):
+                break
+            for number, weight in self.files[path].items():
+                totals[number] += weight
+        return self._named(totals, as_of)
+
+    def experts_for_patch(self, paths, top=10, as_of=None):
+        """
+        The top [(person, score)] summed over the files a patch touches,
+        falling back to the directory rollups for files with no history.
+        """
+        totals = defaultdict(float)
+        for path in paths:
+            for person, score in self.experts_for_file(path, as_of).items():
+                totals[person] += score
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    def files_of(self, person):
+        """The paths a person has touched."""
+        return sorted(self.author_files.get(self.author_numbers.get(person), ()))
+
+    def save(self, path):
+        """
+        Write the index to the directory path: meta.json, author_files.json,
+        and the file and directory vectors spread over shard_NN.json files.
+        """
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        shards = [{"files": {}, "directories": {}} for _ in range(INDEX_SHARDS)]
+        for file, weights in self.files.items():
+            shards[_shard_of(file, INDEX_SHARDS)]["files"][file] = list(weights.items())
+        for directory, weights in self.directories.items():
+            shards[_shard_of(directory, INDEX_SHARDS)]["directories"][directory] = list(weights.items())
+        for i, shard in enumerate(shards):
+            with open(os.path.join(tmp_path, f"shard_{i:02d}.json"), "w", encoding="utf-8") as f:
+                json.dump(shard, f)
+
+        with open(os.path.join(tmp_path, "author_files.json"), "w", encoding="utf-8") as f:
+            json.dump({number: sorted(paths) for number, paths in self.author_files.items()}, f)
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "shards": INDEX_SHARDS,
+                "anchor": self.anchor,
+                "half_life_days": self.half_life_days,
+                "authors": self.authors,
+                "directory_sizes": self.directory_sizes,
+                "history": self.history,
+            }, f)
+
+        # swap the new directory in; a crash in between leaves the old one at path.old
+        old_path = f"{path}.old"
+        if os.path.isdir(path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(path, old_path)
+        elif os.path.exists(path):
+            os.remove(path)  # a single-file index from an older version
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """The whole index saved at path, e.g. to update it."""
+        meta = _read_meta(path)
+        files = {}
+        directories = {}
+        for i in range(meta["shards"]):
+            shard = _read_json(os.path.join(path, f"shard_{i:02d}.json"))
+            files.update(_vectors(shard["files"]))
+            directories.update(_vectors(shard["directories"]))
+        author_files = {int(number): set(paths) for number, paths in _read_json(os.path.join(path, "author_files.json")).items()}
+        return cls(meta["authors"], files, meta["anchor"], meta["half_life_days"], author_files, directories, meta["directory_sizes"], meta["history"])
+
+
+def lookup_experts(index_path, paths, top=10, as_of=None):
+    """
+    experts_for_patch against the index saved at index_path, reading only the
+    shards that hold paths and their ancestor directories rather than loading
+    the whole index.
+    """
+    meta = _read_meta(index_path)
+    keys = set(paths)
+    for path in paths:
+        keys.update(ancestors(path))
+
+    files = {}
+    directories = {}
+    for i in sorted({_shard_of(key, meta["shards"]) for key in keys}):
+        shard = _read_json(os.path.join(index_path, f"shard_{i:02d}.json"))
+        files.update(_vectors({key: vector for key, vector in shard["files"].items() if key in keys}))
+        directories.update(_vectors({key: vector for key, vector in shard["directories"].items() if key in keys}))
+
+    index = ExpertiseIndex(meta["authors"], files, meta["anchor"], meta["half_life_days"], {}, directories, meta["directory_sizes"], meta["history"])
+    return index.experts_for_patch(paths, top, as_of)
+
+
+def build_expertise_index(history_path, half_life_days=HALF_LIFE_DAYS):
+    """Compile an ExpertiseIndex from every row of the history store at history_path."""
+    index = ExpertiseIndex([], {}, None, half_life_days)
+    return update_expertise_index(index, history_path)
+
+
+def update_expertise_index(index, history_path):
+    """
+    Add the history rows the index hasn't seen yet: just the chunks written
+    since it was last built or updated. If the history store was rebuilt in
+    the meantime (e.g. after a force-push), the index is rebuilt from scratch.
+    """
+    store_id = read_manifest(history_path).get("store_id")
+    chunks = committed_chunk_count(history_path)
+    seen = index.history
+    if seen["chunks"] and (seen["store_id"] != store_id or seen["chunks"] > chunks):
+        print("History store was rebuilt, rebuilding the expertise index")
+        index = ExpertiseIndex([], {}, None, index.half_life_days)
+        seen = index.history
+
+    start = seen["chunks"]
+    index.add_rows(lambda: iter_history_rows(history_path, start))
+    index.history = {"store_id": store_id, "chunks": chunks}
+
+    print(f"Indexed {chunks - start} new history chunks: {len(index.files)} files and {len(index.authors)} people")
+    return index
+
+
+if __name__ == "__main__":
+    # usage: python expertise_index.py build <history_dir> <index_path>
+    #        python expertise_index.py update <history_dir> <index_path>
+    #        python expertise_index.py lookup <index_path> <file> [<file> ...]
+    if len(sys.argv) >= 4 and sys.argv[1] == "build":
+        build_expertise_index(sys.argv[2]).save(sys.argv[3])
+    elif len(sys.argv) >= 4 and sys.argv[1] == "update":
+        if os.path.exists(sys.argv[3]):
+            update_expertise_index(ExpertiseIndex.load(sys.argv[3]), sys.argv[2]).save(sys.argv[3])
+        else:
+            build_expertise_index(sys.argv[2]).save(sys.argv[3])
+    elif len(sys.argv) >= 4 and sys.argv[1] == "lookup":
+        for person, score in lookup_experts(sys.argv[2], sys.argv[3:]):
+            print(f"{person}\t{score:.3f}")
+    else:
+        print("usage: python expertise_index.py build <history_dir> <index_path>")
+        print("       python expertise_index.py update <history_dir> <index_path>")
+        print("       python expertise_index.py lookup <index_path> <file> [<file> ...]")
+        sys.exit(1)
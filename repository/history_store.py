@@ -0,0 +1,249 @@
+import os
+import sys
+import csv
+import json
+import uuid
+
+# One row of repo history, in the order collect_repo_history has always produced it.
+COLUMNS = ["person", "file", "additions", "deletions", "commit", "date", "assoc_type"]
+
+# Rows buffered in memory before they're written out as a chunk.
+CHUNK_ROWS = int(os.environ.get("HISTORY_CHUNK_ROWS", 100000))
+
+MANIFEST = "manifest.json"
+
+# The person and file dictionaries, one JSON string per line, in id order.
+PEOPLE = "people.jsonl"
+FILES = "files.jsonl"
+
+
+def _write_json_atomic(path, value):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        # store_id tells consumers that read part of a store apart from a rebuilt one
+        return {"columns": COLUMNS, "chunks": [], "rows": 0, "people": 0, "files": 0, "committed_chunks": 0, "store_id": uuid.uuid4().hex}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _committed_chunks(manifest):
+    # stores written before commit() existed count as fully committed
+    return manifest["chunks"][:manifest.get("committed_chunks", len(manifest["chunks"]))]
+
+
+def _read_lines(path, count):
+    """The first count strings of a dictionary file; lines past them are from an unfinished run."""
+    values = []
+    if count == 0:
+        return values
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            values.append(json.loads(line))
+            if len(values) == count:
+                break
+    return values
+
+
+def _write_lines(path, values):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for value in values:
+            f.write(json.dumps(value) + "\n")
+    os.replace(tmp_path, path)
+
+
+def _read_dictionaries(path, chunks):
+    """
+    The people and files lists (id -> string) as of the last of chunks. Stores
+    written before the dictionaries had their own files keep each chunk's new
+    strings in the chunk itself, so those have to be read in full.
+    """
+    if not chunks:
+        return [], []
+    if "people" in chunks[-1]:
+        return (_read_lines(os.path.join(path, PEOPLE), chunks[-1]["people"]),
+                _read_lines(os.path.join(path, FILES), chunks[-1]["files"]))
+
+    people = []
+    files = []
+    for chunk in chunks:
+        data = _read_chunk(path, chunk)
+        people.extend(data["new_people"])
+        files.extend(data["new_files"])
+        chunk["people"] = len(people)
+        chunk["files"] = len(files)
+    return people, files
+
+
+class HistoryWriter:
+    """
+    Appends repo history rows to a directory of columnar JSON chunks, so the
+    whole history never has to sit in memory (or in one giant JSON array).
+
+    Person and file strings are dictionary-encoded: chunks store small integer
+    ids, and the strings live in people.jsonl and files.jsonl, which only ever
+    get appended to. manifest.json lists the finished chunks, with how many
+    people and files there were once each was written, and is only rewritten
+    after a chunk and its strings are safely on disk, so a crash loses at most
+    the rows that were still buffered.
+
+    Opening an existing directory appends to it. Chunks written after the last
+    commit() are dropped when the store is reopened (and ignored by readers),
+    so a run that dies halfway can simply be run again.
+    """
+
+    def __init__(self, path, chunk_rows=CHUNK_ROWS):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.manifest = read_manifest(path)
+
+        committed = _committed_chunks(self.manifest)
+        if len(committed) < len(self.manifest["chunks"]):
+            print(f"Dropping {len(self.manifest['chunks']) - len(committed)} chunks from an unfinished run")
+            self.manifest["chunks"] = committed
+            self.manifest["rows"] = sum(chunk["rows"] for chunk in committed)
+
+        people, files = _read_dictionaries(path, self.manifest["chunks"])
+        # rewritten so strings from an unfinished run (or, for an older store,
+        # all of them) are where the next flush appends
+        _write_lines(os.path.join(path, PEOPLE), people)
+        _write_lines(os.path.join(path, FILES), files)
+        self.people = {person: i for i, person in enumerate(people)}
+        self.files = {file_path: i for i, file_path in enumerate(files)}
+        self.manifest["people"] = len(people)
+        self.manifest["files"] = len(files)
+
+        self._reset_buffer()
+
+    def _reset_buffer(self):
+        self.buffer = {column: [] for column in COLUMNS}
+        self.new_people = []
+        self.new_files = []
+
+    def _encode(self, dictionary, new_values, value):
+        if value not in dictionary:
+            dictionary[value] = len(dictionary)
+            new_values.append(value)
+        return dictionary[value]
+
+    def append(self, rows):
+        """Add [person, file, additions, deletions, commit, date, assoc_type] rows."""
+        for person, file_path, additions, deletions, commit, date, assoc_type in rows:
+            self.buffer["person"].append(self._encode(self.people, self.new_people, person))
+            self.buffer["file"].append(self._encode(self.files, self.new_files, file_path))
+            self.buffer["additions"].append(additions)
+            self.buffer["deletions"].append(deletions)
+            self.buffer["commit"].append(commit)
+            self.buffer["date"].append(date)
+            self.buffer["assoc_type"].append(assoc_type)
+
+        if len(self.buffer["person"]) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        rows = len(self.buffer["person"])
+        if rows == 0:
+            return
+
+        for file_name, values in ((PEOPLE, self.new_people), (FILES, self.new_files)):
+            with open(os.path.join(self.path, file_name), "a", encoding="utf-8") as f:
+                for value in values:
+                    f.write(json.dumps(value) + "\n")
+
+        name = f"chunk_{len(self.manifest['chunks']):05d}.json"
+        _write_json_atomic(os.path.join(self.path, name), {"columns": self.buffer})
+
+        self.manifest["chunks"].append({"name": name, "rows": rows, "people": len(self.people), "files": len(self.files)})
+        self.manifest["rows"] += rows
+        self.manifest["people"] = len(self.people)
+        self.manifest["files"] = len(self.files)
+        _write_json_atomic(os.path.join(self.path, MANIFEST), self.manifest)
+
+        self._reset_buffer()
+
+    def commit(self, **state):
+        """
+        Flush, then mark everything written so far as complete, recording state
+        (e.g. the last git commit ingested) in the manifest alongside it.
+        """
+        self.flush()
+        self.manifest.update(state)
+        self.manifest["committed_chunks"] = len(self.manifest["chunks"])
+        _write_json_atomic(os.path.join(self.path, MANIFEST), self.manifest)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_chunk(path, chunk):
+    with open(os.path.join(path, chunk["name"]), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def committed_chunk_count(path):
+    """How many chunks of the store are complete; pass it as start later to read only what's new."""
+    return len(_committed_chunks(read_manifest(path)))
+
+
+def iter_history_chunks(path, start=0):
+    """
+    Yield each chunk from the start'th on as a dict of decoded columns
+    (column name -> list), one chunk in memory at a time.
+    """
+    chunks = _committed_chunks(read_manifest(path))
+    people, files = _read_dictionaries(path, chunks)
+    for chunk in chunks[start:]:
+        columns = _read_chunk(path, chunk)["columns"]
+        columns["person"] = [people[i] for i in columns["person"]]
+        columns["file"] = [files[i] for i in columns["file"]]
+        yield columns
+
+
+def iter_history_rows(path, start=0):
+    """Yield [person, file, additions, deletions, commit, date, assoc_type] rows, from the start'th chunk on."""
+    for columns in iter_history_chunks(path, start):
+        yield from zip(*(columns[column] for column in COLUMNS))
+
+
+def read_person_ids(identities_path):
+    """{alias: person id} from the identities.csv analyze_commitfest.py writes."""
+    with open(identities_path, "r", encoding="utf-8", newline="") as f:
+        return {row["alias"]: int(row["person_id"]) for row in csv.DictReader(f)}
+
+
+def export_csv(path, csv_path, identities_path=None):
+    """
+    Write every row to a CSV file, in the column order of the commitstats
+    table, followed by the person id its person resolves to in identities_path
+    (empty if there's none).
+    """
+    person_ids = read_person_ids(identities_path) if identities_path else {}
+    rows = 0
+    with open(csv_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        for row in iter_history_rows(path):
+            writer.writerow(list(row) + [person_ids.get(row[0])])
+            rows += 1
+    print(f"Done! Wrote {rows} records to {csv_path}")
+
+
+if __name__ == "__main__":
+    # usage: python history_store.py csv <history_dir> <csv_path> [<identities_csv>]
+    if len(sys.argv) not in (4, 5) or sys.argv[1] != "csv":
+        print("usage: python history_store.py csv <history_dir> <csv_path> [<identities_csv>]")
+        sys.exit(1)
+    export_csv(*sys.argv[2:])
@@ -9,11 +9,14 @@ CREATE TABLE commitstats (
     deletions INT,
     commit TEXT,
     date TIMESTAMPTZ,
-    assoc_type TEXT
+    assoc_type TEXT,
+    person_id INT  -- see commitfest/identities.py
 );
 
 -- 3. (Optional) Truncate if we want to be sure we're starting from an empty table
 TRUNCATE TABLE commitstats;
 
--- 4. Ingest data from the JSON file using jq to transform JSON -> CSV
-\copy commitstats (author, file, additions, deletions, commit, date, assoc_type) FROM PROGRAM 'jq -r ".[] | @csv" repo_history.json' CSV QUOTE '"' ESCAPE '\';
\ No newline at end of file
+-- 4. Export the history store (see analyze_repo.py) to CSV, resolving each author
+--    to a person id with the identities.csv analyze_commitfest.py wrote, and ingest that
+\! python ../repository/history_store.py csv repo_history repo_history.csv identities.csv
+\copy commitstats (author, file, additions, deletions, commit, date, assoc_type, person_id) FROM 'repo_history.csv' CSV
\ No newline at end of file
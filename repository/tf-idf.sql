@@ -5,10 +5,11 @@ drop materialized view if exists contrib_tf cascade;
 
 create  materialized view contrib_tf as 
     select 
-        normalize_name_email(author) author,
+        person_id,
          file, 
          sum(ln(1 + additions + deletions)) tf 
     from commitstats 
+    where person_id is not null
     group by 1, 2;
 
 -- IDF
@@ -22,7 +23,7 @@ create materialized view contrib_idf as
     )
     select 
         file,
-        (select count(distinct author) from contrib_tf) / cnt idf
+        (select count(distinct person_id) from contrib_tf) / cnt idf
     from file_cnt;
 
 
@@ -33,7 +34,8 @@ create materialized view perfile_tf_idf as
     select 
         p.patch patch,
         tf.file file, 
-        tf.author reviewer, 
+        tf.person_id reviewer_id, 
+        people.name reviewer, 
         a.additions,
         a.deletion deletions,
         tf.tf * idf.idf unweighted_tf_idf,
@@ -43,22 +45,24 @@ create materialized view perfile_tf_idf as
         join contrib_idf idf on tf.file = idf.file
         join attachment_stats a on a.file = tf.file
         join patch_message p on p.message = a.message_id
+        join people on people.person_id = tf.person_id
 ;
 
 drop materialized view if exists contrib_tf_idf cascade;
 
 create materialized view contrib_tf_idf as 
     SELECT 
+        reviewer_id, 
         reviewer, 
         patch, 
         AVG(tf_idf) AS total_tf_idf,
-        RANK() OVER (PARTITION BY reviewer ORDER BY AVG(tf_idf) DESC) AS rank,
+        RANK() OVER (PARTITION BY reviewer_id ORDER BY AVG(tf_idf) DESC) AS rank,
         sum(additions) as additions,
         sum(deletions) as delections
     FROM 
         perfile_tf_idf f
     GROUP BY 
-        reviewer, patch
+        reviewer_id, reviewer, patch
     ORDER BY 
         reviewer ASC, rank ASC;
 ;